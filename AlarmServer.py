@@ -5,6 +5,7 @@ import os, sys, struct, json
 from time import sleep
 from socket import *
 from datetime import *
+from dvrip_framing import HEADER_SIZE, unpack_header
 
 if len(sys.argv) > 1:
     port = sys.argv[1]
@@ -34,15 +35,20 @@ def GetIP(s):
 while True:
     try:
         conn, addr = server.accept()
-        head, version, session, sequence_number, msgid, len_data = struct.unpack(
-            "BB2xII2xHI", conn.recv(20)
-        )
+        header = unpack_header(conn.recv(HEADER_SIZE))
         sleep(0.1)  # Just for recive whole packet
-        data = conn.recv(len_data)
+        data = conn.recv(header.length)
         conn.close()
         reply = json.loads(data, encoding="utf8")
         print(datetime.now().strftime("[%Y-%m-%d %H:%M:%S]>>>"))
-        print(head, version, session, sequence_number, msgid, len_data)
+        print(
+            header.head,
+            header.version,
+            header.session,
+            header.sequence,
+            header.msgid,
+            header.length,
+        )
         print(json.dumps(reply, indent=4, sort_keys=True))
         print("<<<")
         tolog(repr(data) + "\r\n")
@@ -8,6 +8,7 @@ import platform
 from datetime import *
 import hashlib, base64
 from dvrip import DVRIPCam
+from dvrip_framing import HEADER_SIZE, build_packet, pack_header, unpack_header
 
 try:
     try:
@@ -210,17 +211,14 @@ def SearchXM(devices):
     server.settimeout(1)
     server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
     server.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-    server.sendto(
-        struct.pack("BBHIIHHI", 255, 0, 0, 0, 0, 0, 1530, 0), ("255.255.255.255", 34569)
-    )
+    server.sendto(pack_header(1530, 0), ("255.255.255.255", 34569))
     while True:
         data = server.recvfrom(1024)
-        head, ver, typ, session, packet, info, msg, leng = struct.unpack(
-            "BBHIIHHI", data[0][:20]
-        )
-        if (msg == 1531) and leng > 0:
+        header = unpack_header(data[0])
+        leng = header.length
+        if (header.msgid == 1531) and leng > 0:
             answer = json.loads(
-                data[0][20 : 20 + leng].replace(b"\x00", b""))
+                data[0][HEADER_SIZE : HEADER_SIZE + leng].replace(b"\x00", b""))
             if answer["NetWork.NetCommon"]["MAC"] not in devices.keys():
                 devices[answer["NetWork.NetCommon"]["MAC"]] = answer[
                     "NetWork.NetCommon"
@@ -460,34 +458,19 @@ def ConfigXM(data):
     server.settimeout(1)
     server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
     server.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-    clen = len(config)
     server.sendto(
-        struct.pack(
-            "BBHIIHHI%ds2s" % clen,
-            255,
-            0,
-            254,
-            0,
-            0,
-            0,
-            1532,
-            clen + 2,
-            config,
-            b"\x0a\x00",
-        ),
-        ("255.255.255.255", 34569),
+        build_packet(1532, config, reserved=254), ("255.255.255.255", 34569)
     )
     answer = {"Ret": 203}
     e = 0
     while True:
         try:
             data = server.recvfrom(1024)
-            head, ver, typ, session, packet, info, msg, leng = struct.unpack(
-                "BBHIIHHI", data[0][:20]
-            )
-            if (msg == 1533) and leng > 0:
+            header = unpack_header(data[0])
+            leng = header.length
+            if (header.msgid == 1533) and leng > 0:
                 answer = json.loads(
-                    data[0][20 : 20 + leng].replace(b"\x00", b""))
+                    data[0][HEADER_SIZE : HEADER_SIZE + leng].replace(b"\x00", b""))
                 break
         except:
             e += 1
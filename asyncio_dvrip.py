@@ -1,12 +1,24 @@
 import os
 import struct
-import json
 import hashlib
 import asyncio
 from datetime import *
 from re import compile
 import time
 import logging
+from dvrip_audio import pcm_frame
+from dvrip_codec import codec, templates
+from dvrip_framing import (
+    HEADER_SIZE,
+    JPEG,
+    MEDIA_TYPE,
+    build_packet,
+    make_frame,
+    media_header_size,
+    pack_header,
+    parse_media_header,
+    unpack_header,
+)
 
 class SomethingIsWrongWithCamera(Exception):
     pass
@@ -149,6 +161,8 @@ class DVRIPCam(object):
         while True:
             try:
                 data = await asyncio.wait_for(self.socket_recv(length - received), timeout=self.timeout)
+                if not data:
+                    return None
                 buf.extend(data)
                 received += len(data)
                 if length == received:
@@ -167,47 +181,55 @@ class DVRIPCam(object):
 
         self.packet_count += 1
         self.logger.debug("<= %s", data)
-        reply = json.loads(data[:-2])
+        reply = codec.loads(data[:-2])
         return reply
 
     async def send(self, msg, data={}, wait_response=True):
         if self.socket_writer is None:
             return {"Ret": 101}
         await self.busy.acquire()
-        if hasattr(data, "__iter__"):
-            data = bytes(json.dumps(data, ensure_ascii=False), "utf-8")
-        pkt = (
-            struct.pack(
-                "BB2xII2xHI",
-                255,
-                0,
-                self.session,
-                self.packet_count,
-                msg,
-                len(data) + 2,
-            )
-            + data
-            + b"\x0a\x00"
-        )
+        if not isinstance(data, (bytes, bytearray)):
+            data = codec.dumps(data)
+        pkt = build_packet(msg, data, self.session, self.packet_count)
         self.logger.debug("=> %s", pkt)
         self.socket_send(pkt)
         if wait_response:
             reply = {"Ret": 101}
-            data = await self.socket_recv(20)
-            if data is None or len(data) < 20:
+            data = await self.socket_recv(HEADER_SIZE)
+            if data is None or len(data) < HEADER_SIZE:
                 return None
-            (
-                head,
-                version,
-                self.session,
-                sequence_number,
-                msgid,
-                len_data,
-            ) = struct.unpack("BB2xII2xHI", data)
-            reply = await self.receive_json(len_data)
+            header = unpack_header(data)
+            self.session = header.session
+            reply = await self.receive_json(header.length)
             self.busy.release()
             return reply
 
+    async def send_many(self, requests):
+        """Send (msg, data) requests back-to-back and read the replies in order.
+
+        A missing reply is returned as None.
+        """
+        if self.socket_writer is None:
+            return [{"Ret": 101} for request in requests]
+        replies = []
+        async with self.busy:
+            pkts = []
+            for i, (msg, data) in enumerate(requests):
+                if not isinstance(data, (bytes, bytearray)):
+                    data = codec.dumps(data)
+                pkts.append(build_packet(msg, data, self.session, self.packet_count + i))
+            pkt = b"".join(pkts)
+            self.logger.debug("=> %s", pkt)
+            self.socket_send(pkt)
+            for request in requests:
+                data = await self.receive_with_timeout(HEADER_SIZE)
+                if data is None:
+                    break
+                header = unpack_header(data)
+                self.session = header.session
+                replies.append(await self.receive_json(header.length))
+        return replies + [None] * (len(requests) - len(replies))
+
     def sofia_hash(self, password=""):
         md5 = hashlib.md5(bytes(password, "utf-8")).digest()
         chars = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
@@ -382,17 +404,9 @@ class DVRIPCam(object):
     async def channel_bitmap(self, width, height, bitmap):
         header = struct.pack("HH12x", width, height)
         self.socket_send(
-            struct.pack(
-                "BB2xII2xHI",
-                255,
-                0,
-                self.session,
-                self.packet_count,
-                0x041A,
-                len(bitmap) + 16,
+            build_packet(
+                0x041A, header + bitmap, self.session, self.packet_count, tail=b""
             )
-            + header
-            + bitmap
         )
         reply, rcvd = await self.recv_json()
         if reply and reply["Ret"] != 100:
@@ -418,21 +432,17 @@ class DVRIPCam(object):
         while True:
             await self.busy.acquire()
             try:
-                (
-                    head,
-                    version,
-                    session,
-                    sequence_number,
-                    msgid,
-                    len_data,
-                ) = struct.unpack("BB2xII2xHI", await self.socket_recv(20))
+                header = unpack_header(await self.socket_recv(HEADER_SIZE))
                 await asyncio.sleep(0.1)  # Just for receive whole packet
-                reply = await self.socket_recv(len_data)
+                reply = await self.socket_recv(header.length)
                 self.packet_count += 1
-                reply = json.loads(reply[:-2])
-                if msgid == self.QCODES["AlarmInfo"] and self.session == session:
+                reply = codec.loads(reply[:-2])
+                if (
+                    header.msgid == self.QCODES["AlarmInfo"]
+                    and self.session == header.session
+                ):
                     if self.alarm_func is not None:
-                        self.alarm_func(reply[reply["Name"]], sequence_number)
+                        self.alarm_func(reply[reply["Name"]], header.sequence)
             except:
                 pass
             finally:
@@ -450,7 +460,7 @@ class DVRIPCam(object):
 
             ret = await self.send(
                 self.QCODES["KeepAlive"],
-                {"Name": "KeepAlive", "SessionID": "0x%08X" % self.session},
+                templates.command("KeepAlive").render(self.session),
             )
             if ret is None:
                 self.close()
@@ -529,6 +539,37 @@ class DVRIPCam(object):
             code, {"Name": command, "SessionID": "0x%08X" % self.session, command: data}
         )
 
+    async def set_info_many(self, mapping):
+        names = list(mapping)
+        session = "0x%08X" % self.session
+        replies = await self.send_many(
+            [
+                (1040, {"Name": name, "SessionID": session, name: mapping[name]})
+                for name in names
+            ]
+        )
+        results = {}
+        errors = {}
+        for name, reply in zip(names, replies):
+            results[name] = reply
+            if reply is None or reply.get("Ret") not in self.OK_CODES:
+                errors[name] = reply
+        return results, errors
+
+    async def get_info_many(self, names):
+        names = list(names)
+        replies = await self.send_many(
+            [(1042, templates.command(name).render(self.session)) for name in names]
+        )
+        results = {}
+        errors = {}
+        for name, reply in zip(names, replies):
+            if reply is not None and reply.get("Ret") in self.OK_CODES and name in reply:
+                results[name] = reply[name]
+            else:
+                errors[name] = reply
+        return results, errors
+
     async def get_info(self, command):
         return await self.get_command(command, 1042)
 
@@ -536,7 +577,7 @@ class DVRIPCam(object):
         if not code:
             code = self.QCODES[command]
 
-        data = await self.send(code, {"Name": command, "SessionID": "0x%08X" % self.session})
+        data = await self.send(code, templates.command(command).render(self.session))
         if data["Ret"] in self.OK_CODES and command in data:
             return data[command]
         else:
@@ -596,7 +637,7 @@ class DVRIPCam(object):
         if m is None:
             return None, buf
         buf = buf[m.span(1)[1] :]
-        return json.loads(m.group(1)), buf
+        return codec.loads(m.group(1)), buf
 
     async def get_upgrade_info(self):
         return await self.get_command("OPSystemUpgrade")
@@ -621,10 +662,9 @@ class DVRIPCam(object):
                 bytes = f.read(packetsize)
                 if not bytes:
                     break
-                header = struct.pack(
-                    "BB2xII2xHI", 255, 0, self.session, blocknum, 0x5F2, len(bytes)
+                self.socket_send(
+                    build_packet(0x5F2, bytes, self.session, blocknum, tail=b"")
                 )
-                self.socket_send(header + bytes)
                 blocknum += 1
                 sentbytes += len(bytes)
 
@@ -637,7 +677,7 @@ class DVRIPCam(object):
                 vprint(f"Uploaded {progress:.2f}%")
         vprint("End of file")
 
-        pkt = struct.pack("BB2xIIxBHI", 255, 0, self.session, blocknum, 1, 0x05F2, 0)
+        pkt = pack_header(0x05F2, 0, self.session, blocknum, cur=1)
         self.socket_send(pkt)
         vprint("Waiting for upgrade...")
         while True:
@@ -664,81 +704,25 @@ class DVRIPCam(object):
             vprint(f"Upgraded {data['Ret']}%")
 
     async def reassemble_bin_payload(self, metadata={}):
-        def internal_to_type(data_type, value):
-            if data_type == 0x1FC or data_type == 0x1FD:
-                if value == 1:
-                    return "mpeg4"
-                elif value == 2:
-                    return "h264"
-                elif value == 3:
-                    return "h265"
-            elif data_type == 0x1F9:
-                if value == 1 or value == 6:
-                    return "info"
-            elif data_type == 0x1FA:
-                if value == 0xE:
-                    return "g711a"
-            elif data_type == 0x1FE and value == 0:
-                return "jpeg"
-            return None
-
-        def internal_to_datetime(value):
-            second = value & 0x3F
-            minute = (value & 0xFC0) >> 6
-            hour = (value & 0x1F000) >> 12
-            day = (value & 0x3E0000) >> 17
-            month = (value & 0x3C00000) >> 22
-            year = ((value & 0xFC000000) >> 26) + 2000
-            return datetime(year, month, day, hour, minute, second)
-
         length = 0
         buf = bytearray()
         start_time = time.time()
 
         while True:
-            data = await self.receive_with_timeout(20)
-            (
-                head,
-                version,
-                session,
-                sequence_number,
-                total,
-                cur,
-                msgid,
-                len_data,
-            ) = struct.unpack("BB2xIIBBHI", data)
-            packet = await self.receive_with_timeout(len_data)
+            data = await self.receive_with_timeout(HEADER_SIZE)
+            if data is None:
+                return None
+            packet = await self.receive_with_timeout(unpack_header(data).length)
+            if packet is None:
+                return None
             frame_len = 0
             if length == 0:
-                media = None
-                frame_len = 8
-                (data_type,) = struct.unpack(">I", packet[:4])
-                if data_type == 0x1FC or data_type == 0x1FE:
-                    frame_len = 16
-                    (media, metadata["fps"], w, h, dt, length,) = struct.unpack(
-                        "BBBBII", packet[4:frame_len]
-                    )
-                    metadata["width"] = w * 8
-                    metadata["height"] = h * 8
-                    metadata["datetime"] = internal_to_datetime(dt)
-                    if data_type == 0x1FC:
-                        metadata["frame"] = "I"
-                elif data_type == 0x1FD:
-                    (length,) = struct.unpack("I", packet[4:frame_len])
-                    metadata["frame"] = "P"
-                elif data_type == 0x1FA:
-                    (media, samp_rate, length) = struct.unpack(
-                        "BBH", packet[4:frame_len]
-                    )
-                elif data_type == 0x1F9:
-                    (media, n, length) = struct.unpack("BBH", packet[4:frame_len])
+                (data_type,) = MEDIA_TYPE.unpack_from(packet)
                 # special case of JPEG shapshots
-                elif data_type == 0xFFD8FFE0:
+                if data_type == JPEG:
                     return packet
-                else:
-                    raise ValueError(data_type)
-                if media is not None:
-                    metadata["type"] = internal_to_type(data_type, media)
+                frame_len = media_header_size(data_type)
+                length = parse_media_header(data_type, packet, metadata)
             buf.extend(packet[frame_len:])
             length -= len(packet) - frame_len
             if length == 0:
@@ -787,5 +771,67 @@ class DVRIPCam(object):
             frame = await self.reassemble_bin_payload(meta)
             frame_callback(frame, meta, user)
 
+    def monitor_packet(self, action, params):
+        return build_packet(
+            1410,
+            codec.dumps(
+                {
+                    "Name": "OPMonitor",
+                    "SessionID": "0x%08X" % self.session,
+                    "OPMonitor": {"Action": action, "Parameter": params},
+                }
+            ),
+            self.session,
+            self.packet_count,
+        )
+
+    async def drain_stream(self, quiet=0.5):
+        """Discard the packets of a stopped stream until the socket goes quiet."""
+        try:
+            while await asyncio.wait_for(self.socket_reader.read(0x10000), timeout=quiet):
+                pass
+            return False
+        except asyncio.TimeoutError:
+            return True
+        except (OSError, AttributeError):
+            return False
+
+    async def iter_frames(self, channel=0, stream="Main", pcm=False):
+        """Async generator of Frame records of a live stream.
+
+        Closing the generator stops the stream, so the session can be used
+        for requests again. Wrap it in contextlib.aclosing() when breaking
+        out of the async for loop, otherwise it is closed only once it is
+        garbage collected. With ``pcm`` audio is decoded to 16 bit PCM.
+        """
+        params = {
+            "Channel": channel,
+            "CombinMode": "NONE",
+            "StreamType": stream,
+            "TransMode": "TCP",
+        }
+        data = await self.set_command("OPMonitor", {"Action": "Claim", "Parameter": params})
+        if data is None or data["Ret"] not in self.OK_CODES:
+            raise SomethingIsWrongWithCamera("Cannot claim the stream")
+        self.monitoring = True
+        video = {}
+        broken = False
+        async with self.busy:
+            self.socket_send(self.monitor_packet("Start", params))
+            try:
+                while self.monitoring:
+                    meta = {}
+                    frame = await self.reassemble_bin_payload(meta)
+                    if frame is None:
+                        broken = True
+                        raise SomethingIsWrongWithCamera("Media stream lost")
+                    frame = make_frame(frame, meta, video, channel, stream)
+                    yield pcm_frame(frame) if pcm else frame
+            finally:
+                if not broken:
+                    self.socket_send(self.monitor_packet("Stop", params))
+                    if not await self.drain_stream():
+                        self.close()
+
     def stop_monitor(self):
         self.monitoring = False
@@ -5,6 +5,10 @@ import json
 import logging
 from collections import namedtuple
 from solarcam import SolarCam
+from dvrip import SomethingIsWrongWithCamera
+from dvrip_catalog import RecordingCatalog
+from dvrip_pool import SessionPool
+from dvrip_scheduler import DownloadScheduler
 
 
 def init_logger():
@@ -37,6 +41,8 @@ def load_config():
         "end": os.environ.get("END"),
         "blacklist_path": os.environ.get("BLACKLIST_PATH"),
         "cooldown": int(os.environ.get("COOLDOWN")),
+        "bandwidth": int(os.environ.get("BANDWIDTH", 0)) or None,
+        "catalog_path": os.environ.get("CATALOG_PATH"),
         "dump_local_files": (
             os.environ.get("DUMP_LOCAL_FILES").lower() in ["true", "1", "y", "yes"]
         ),
@@ -55,9 +61,20 @@ def main():
         with open(config.blacklist_path, "r") as file:
             blacklist = [line.rstrip() for line in file]
 
-    while True:
-        solarCam = SolarCam(config.host_ip, config.user, config.password, logger)
+    # keep the logged in session between cycles instead of paying for a
+    # new login and the camera boot wait every time
+    pool = SessionPool(ttl=cooldown * 2 + 60, max_per_camera=1)
+    solarCam = SolarCam(
+        config.host_ip, config.user, config.password, logger, pool=pool
+    )
+    # what is on the camera and what was downloaded, so every cycle only
+    # asks the camera for new recordings
+    catalog = RecordingCatalog(
+        getattr(config, "catalog_path", None) or f"{config.blacklist_path}.db"
+    )
 
+    while True:
+        completed = False
         try:
             solarCam.login()
 
@@ -72,50 +89,81 @@ def main():
 
             sleep(5)  # sleep some seconds so camera can get ready
 
-            pics = solarCam.get_local_files(start, end, "jpg")
-
+            pics = solarCam.sync_files(
+                catalog, config.download_dir_picture, start, end, "jpg", blacklist
+            )
+            videos = solarCam.sync_files(
+                catalog,
+                config.download_dir_video,
+                start,
+                end,
+                "h264",
+                blacklist,
+                target_filetype=config.target_filetype_video,
+            )
+
+            # newest files first, broken downloads are resumed and retried
+            scheduler = DownloadScheduler(
+                pool,
+                workers=1,
+                per_camera=1,
+                bandwidth=getattr(config, "bandwidth", None),
+                retries=2,
+                retry_delay=10,
+                on_done=lambda job: catalog.mark(
+                    config.host_ip,
+                    job.file["FileName"],
+                    "failed" if job.error is not None else "done",
+                ),
+            )
+            queued = []
             if pics:
-                Path(config.download_dir_picture).parent.mkdir(
-                    parents=True, exist_ok=True
+                queued += solarCam.schedule_files(
+                    scheduler, config.download_dir_picture, pics, check=False
                 )
-                solarCam.save_files(
-                    config.download_dir_picture, pics, blacklist=blacklist
-                )
-
-            videos = solarCam.get_local_files(start, end, "h264")
             if videos:
-                Path(config.download_dir_video).parent.mkdir(
-                    parents=True, exist_ok=True
-                )
-                solarCam.save_files(
+                queued += solarCam.schedule_files(
+                    scheduler,
                     config.download_dir_video,
                     videos,
-                    blacklist=blacklist,
                     target_filetype=config.target_filetype_video,
+                    check=False,
                 )
+            # hand the session to the scheduler
+            solarCam.logout()
+            scheduler.start()
+            scheduler.join()
+            scheduler.stop()
+            logger.debug(f"Download stats: {scheduler.stats()['total']}")
+            for target, convert in queued:
+                if convert and Path(target).is_file():
+                    solarCam.convert(target, convert)
 
             if config.dump_local_files:
                 logger.debug(f"Dumping local files...")
                 solarCam.dump_local_files(
-                    videos,
+                    catalog.files(config.host_ip, "h264", start, end),
                     config.blacklist_path,
                     config.download_dir_video,
                     target_filetype=config.target_filetype_video,
                 )
                 solarCam.dump_local_files(
-                    pics, config.blacklist_path, config.download_dir_picture
+                    catalog.files(config.host_ip, "jpg", start, end),
+                    config.blacklist_path, config.download_dir_picture
                 )
-
-            solarCam.logout()
+            completed = True
         except ConnectionRefusedError:
             logger.debug(f"Connection could not be established or got disconnected")
-        except TypeError as e:
+        except (TypeError, SomethingIsWrongWithCamera) as e:
             print(e)
             logger.debug(f"Error while downloading a file")
         except KeyError:
             logger.debug(f"Error while getting the file list")
         except UnicodeDecodeError:
             logger.debug(f"Error while getting battery status")
+        finally:
+            # a session that failed mid-cycle is not handed out again
+            solarCam.logout(discard=not completed)
         logger.debug(f"Sleeping for {cooldown} seconds...")
         sleep(cooldown)
 
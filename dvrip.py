@@ -1,21 +1,337 @@
 import os
 import struct
-import json
 from time import sleep
 import hashlib
 import threading
-from socket import socket, AF_INET, SOCK_STREAM, SOCK_DGRAM
+import heapq
+import random
+from itertools import count
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from socket import socket, AF_INET, SOCK_STREAM, SOCK_DGRAM, SHUT_RDWR
+from socket import timeout as SocketTimeout
+from select import select
 from datetime import *
 from re import compile
 import time
 import logging
-from pathlib import Path
+from copy import deepcopy
+from contextlib import closing
+from dvrip_audio import ENCODE_TYPES, SAMPLE_RATE, encode, pcm_frame, talk_packets
+from dvrip_codec import codec, templates
+from dvrip_download import TIME_FORMAT, PartialDownload
+from dvrip_framing import (
+    HEADER_SIZE,
+    JPEG,
+    MEDIA_TYPE,
+    build_packet,
+    make_frame,
+    media_header_size,
+    pack_header,
+    parse_media_header,
+    unpack_header,
+)
 
 
 class SomethingIsWrongWithCamera(Exception):
     pass
 
 
+class ArenaBuffer(object):
+    """Received frame bytes lent out by a BufferArena.
+
+    ``view`` is a memoryview over exactly the received bytes. The underlying
+    block goes back to the arena when the last holder calls release(), so a
+    consumer that keeps the frame beyond its callback must retain() it first
+    and must not touch ``view`` after its own release().
+    """
+
+    __slots__ = ("arena", "block", "view", "refs")
+
+    def __init__(self, arena, block, size):
+        self.arena = arena
+        self.block = block
+        self.view = memoryview(block)[:size]
+        self.refs = 1
+
+    def __len__(self):
+        return len(self.view)
+
+    def __bytes__(self):
+        return self.view.tobytes()
+
+    def retain(self):
+        with self.arena.lock:
+            self.refs += 1
+        return self
+
+    def release(self):
+        with self.arena.lock:
+            self.refs -= 1
+            if self.refs:
+                return
+        self.view = None
+        self.arena.recycle(self.block)
+        self.block = None
+
+
+class BufferArena(object):
+    """Pool of preallocated receive blocks shared by monitor sessions.
+
+    Frames up to ``block_size`` bytes are received straight into a pooled
+    block with recv_into; larger frames get a one-off block that is dropped
+    on release instead of being pooled.
+    """
+
+    def __init__(self, block_size=0x80000, prealloc=4, max_free=32):
+        self.block_size = block_size
+        self.max_free = max_free
+        self.lock = threading.Lock()
+        self.free = [bytearray(block_size) for _ in range(prealloc)]
+
+    def acquire(self, size):
+        block = None
+        if size <= self.block_size:
+            with self.lock:
+                if self.free:
+                    block = self.free.pop()
+            if block is None:
+                block = bytearray(self.block_size)
+        else:
+            block = bytearray(size)
+        return ArenaBuffer(self, block, size)
+
+    def recycle(self, block):
+        if len(block) != self.block_size:
+            return
+        with self.lock:
+            if len(self.free) < self.max_free:
+                self.free.append(block)
+
+
+class KeepAliveHandle(object):
+    __slots__ = ("scheduler", "cam", "interval", "missed", "cancelled")
+
+    def __init__(self, scheduler, cam, interval):
+        self.scheduler = scheduler
+        self.cam = cam
+        self.interval = interval
+        self.missed = 0
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class KeepAliveScheduler(object):
+    """Sends KeepAlive for any number of sessions from a fixed set of threads.
+
+    One scheduler thread keeps a heap of due times and hands due sessions to
+    a small worker pool, so the thread count does not grow with the number
+    of cameras. Every send is pulled forward by a random part of ``jitter``
+    of the interval to spread the load. A session that is streaming a
+    monitor, or whose lock is held by a thread still receiving data, is
+    skipped; one whose lock stays taken without traffic counts as missed.
+    After ``max_missed`` failed keep-alives in a row the session is
+    reported dead to the listeners and to DVRIPCam.session_dead().
+    """
+
+    default = None
+
+    def __init__(self, workers=4, jitter=0.2, max_missed=1):
+        self.logger = logging.getLogger(__name__)
+        self.jitter = jitter
+        self.max_missed = max_missed
+        self.heap = []
+        self.order = count()
+        self.listeners = []
+        self.lock = threading.Condition()
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="DVRKeepAlive"
+        )
+        self.thread = threading.Thread(name="DVRKeepAliveScheduler", target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @classmethod
+    def get_default(cls):
+        if cls.default is None:
+            cls.default = cls()
+        return cls.default
+
+    def add_listener(self, func):
+        """func(cam, missed, dead) is called for every missed keep-alive."""
+        self.listeners.append(func)
+
+    def register(self, cam, interval):
+        handle = KeepAliveHandle(self, cam, interval)
+        self.schedule(handle)
+        return handle
+
+    def schedule(self, handle):
+        delay = handle.interval * (1 - self.jitter * random.random())
+        with self.lock:
+            heapq.heappush(self.heap, (time.time() + delay, next(self.order), handle))
+            self.lock.notify()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.lock.wait(self.heap[0][0] - time.time() if self.heap else None)
+                due, order, handle = heapq.heappop(self.heap)
+            if not handle.cancelled:
+                self.executor.submit(self.ping, handle)
+
+    def ping(self, handle):
+        cam = handle.cam
+        if cam.socket is None:
+            return
+        locked = False
+        if cam.pending is None:
+            if cam.monitoring:
+                # the media traffic keeps the session alive
+                handle.missed = 0
+                self.schedule(handle)
+                return
+            locked = cam.busy.acquire(timeout=min(cam.timeout, handle.interval))
+            if not locked and time.monotonic() - cam.last_rx < handle.interval:
+                # a download or stream is running, its traffic does it
+                handle.missed = 0
+                self.schedule(handle)
+                return
+        ret = None
+        try:
+            if locked or cam.pending is not None:
+                ret = cam.send(
+                    cam.QCODES["KeepAlive"],
+                    templates.command("KeepAlive").render(cam.session),
+                )
+            else:
+                self.logger.debug("Session of %s stays busy without traffic", cam.ip)
+        except Exception as e:
+            # counted as missed, so the session is retried or reported dead
+            self.logger.debug("Keep-alive for %s failed: %s", cam.ip, e)
+        finally:
+            if locked:
+                cam.busy.release()
+        if handle.cancelled:
+            return
+        if ret is not None:
+            handle.missed = 0
+            self.schedule(handle)
+            return
+        handle.missed += 1
+        dead = handle.missed >= self.max_missed
+        self.logger.debug(
+            "Missed keep-alive %d for %s, dead: %s", handle.missed, cam.ip, dead
+        )
+        for func in self.listeners:
+            func(cam, handle.missed, dead)
+        if dead:
+            handle.cancel()
+            cam.session_dead()
+        else:
+            self.schedule(handle)
+
+
+class ResponseCache(object):
+    """TTL cache of get_command replies keyed by (command, code).
+
+    ``ttls`` overrides the default ``ttl`` per command name, a TTL of 0
+    disables caching for that command. invalidate() drops every entry whose
+    key path contains or is contained in the written path, so a write to
+    "Camera.Param.[0]" drops cached "Camera" and "Camera.Param.[0]" replies.
+    """
+
+    VOLATILE = {"OPTimeQuery": 0, "OPSystemUpgrade": 0, "KeepAlive": 0}
+
+    def __init__(self, ttl=60, ttls=None):
+        self.ttl = ttl
+        self.ttls = dict(self.VOLATILE)
+        self.ttls.update(ttls or {})
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, command, code):
+        with self.lock:
+            entry = self.entries.get((command, code))
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                return True, deepcopy(entry[1])
+            self.misses += 1
+        return False, None
+
+    def put(self, command, code, value):
+        ttl = self.ttls.get(command, self.ttl)
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.entries[(command, code)] = (time.time() + ttl, deepcopy(value))
+
+    def invalidate(self, path=None):
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+                return
+            for key in list(self.entries):
+                command = key[0]
+                if (
+                    command == path
+                    or command.startswith(path + ".")
+                    or path.startswith(command + ".")
+                ):
+                    del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+
+class ReconnectPolicy(object):
+    """Exponential backoff with jitter for DVRIPCam.reconnect().
+
+    The first attempt is made right away, then the delay starts at
+    ``initial`` seconds and is multiplied by ``factor`` up to ``maximum``,
+    each wait shortened by a random part of ``jitter`` so a fleet of
+    cameras behind one broken switch does not retry in lockstep.
+    ``max_attempts`` of None retries until the session is closed.
+    """
+
+    def __init__(self, initial=1, maximum=60, factor=2, jitter=0.5, max_attempts=None):
+        self.logger = logging.getLogger(__name__)
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+        self.listeners = []
+
+    def add_listener(self, func):
+        """func(cam, event, info) is called for every outage event.
+
+        Events are "lost", "retry" (attempt, delay), "restored" (attempts,
+        outage in seconds) and "failed" (attempts, outage).
+        """
+        self.listeners.append(func)
+
+    def notify(self, cam, event, **info):
+        self.logger.info("Session to %s %s %s", cam.ip, event, info)
+        for func in self.listeners:
+            func(cam, event, info)
+
+    def delays(self):
+        yield 0
+        delay = self.initial
+        attempt = 1
+        while self.max_attempts is None or attempt < self.max_attempts:
+            yield delay * (1 - self.jitter * random.random())
+            delay = min(delay * self.factor, self.maximum)
+            attempt += 1
+
+
 class DVRIPCam(object):
     DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
     CODES = {
@@ -114,7 +430,24 @@ class DVRIPCam(object):
         self.alive = None
         self.alarm = None
         self.alarm_func = None
+        self.keepalive_scheduler = kwargs.get("keepalive_scheduler")
+        self.cache = None
+        self.reconnect_policy = kwargs.get("reconnect")
+        self.reconnect_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.closes = 0
+        self.generation = 0
+        self.alarm_subscribed = False
+        self.monitoring = False
+        self.talk_law = "alaw"
         self.busy = threading.Condition()
+        self.send_lock = threading.Lock()
+        self.pending = None
+        self.reader = None
+        self.last_rx = 0.0  # time.monotonic() of the last packet received
+        self.arena = kwargs.get("arena")
+        self.header_buf = bytearray(HEADER_SIZE)
+        self.media_buf = bytearray(16)
 
     def debug(self, format=None):
         self.logger.setLevel(logging.DEBUG)
@@ -129,11 +462,13 @@ class DVRIPCam(object):
             if self.proto == "tcp":
                 self.socket_send = self.tcp_socket_send
                 self.socket_recv = self.tcp_socket_recv
+                self.socket_recv_into = self.tcp_socket_recv_into
                 self.socket = socket(AF_INET, SOCK_STREAM)
                 self.socket.connect((self.ip, self.port))
             elif self.proto == "udp":
                 self.socket_send = self.udp_socket_send
                 self.socket_recv = self.udp_socket_recv
+                self.socket_recv_into = self.udp_socket_recv_into
                 self.socket = socket(AF_INET, SOCK_DGRAM)
             else:
                 raise f"Unsupported protocol {self.proto}"
@@ -145,12 +480,28 @@ class DVRIPCam(object):
             raise SomethingIsWrongWithCamera("Cannot connect to camera")
 
     def close(self):
+        # reconnect() and anything waiting on stopped give up; a reconnect
+        # in flight notices by the changed count even if login() runs again
+        self.closes += 1
+        self.stopped.set()
+        self.disconnect()
+
+    def disconnect(self):
+        sock = self.socket
+        self.socket = None
         try:
             self.alive.cancel()
-            self.socket.close()
         except:
             pass
-        self.socket = None
+        try:
+            # wake up the multiplex reader or alarm thread blocked in recv
+            sock.shutdown(SHUT_RDWR)
+        except:
+            pass
+        try:
+            sock.close()
+        except:
+            pass
 
     def udp_socket_send(self, bytes):
         return self.socket.sendto(bytes, (self.ip, self.port))
@@ -159,6 +510,10 @@ class DVRIPCam(object):
         data, _ = self.socket.recvfrom(bytes)
         return data
 
+    def udp_socket_recv_into(self, view):
+        nbytes, _ = self.socket.recvfrom_into(view)
+        return nbytes
+
     def tcp_socket_send(self, bytes):
         try:
             return self.socket.sendall(bytes)
@@ -171,20 +526,32 @@ class DVRIPCam(object):
         except:
             return None
 
-    def receive_with_timeout(self, length):
+    def tcp_socket_recv_into(self, view):
+        try:
+            return self.socket.recv_into(view)
+        except:
+            return None
+
+    def receive_into(self, view):
+        length = len(view)
         received = 0
-        buf = bytearray()
         start_time = time.time()
 
-        while True:
-            data = self.socket_recv(length - received)
-            buf.extend(data)
-            received += len(data)
-            if length == received:
-                break
+        while received < length:
+            nbytes = self.socket_recv_into(view[received:])
+            if not nbytes:
+                return False
+            received += nbytes
             elapsed_time = time.time() - start_time
-            if elapsed_time > self.timeout:
-                return None
+            if received < length and elapsed_time > self.timeout:
+                return False
+        self.last_rx = time.monotonic()
+        return True
+
+    def receive_with_timeout(self, length):
+        buf = bytearray(length)
+        if not self.receive_into(memoryview(buf)):
+            return None
         return buf
 
     def receive_json(self, length):
@@ -194,101 +561,251 @@ class DVRIPCam(object):
 
         self.packet_count += 1
         self.logger.debug("<= %s", data)
-        reply = json.loads(data[:-2])
+        reply = codec.loads(data[:-2])
         return reply
 
     def send_custom(
-        self, msg, data={}, wait_response=True, download=False, size=None, version=0
+        self,
+        msg,
+        data={},
+        wait_response=True,
+        download=False,
+        size=None,
+        version=0,
+        sink=None,
+        progress=None,
     ):
         if self.socket is None:
             return {"Ret": 101}
-        # self.busy.wait()
-        self.busy.acquire()
-        if hasattr(data, "__iter__"):
-            if version == 1:
-                data["SessionID"] = f"{self.session:#0{12}x}"
-            data = bytes(
-                json.dumps(data, ensure_ascii=False, separators=(",", ":")), "utf-8"
+        self.check_direct("send_custom()")
+        with self.busy:
+            if not isinstance(data, (bytes, bytearray)):
+                if version == 1:
+                    data["SessionID"] = f"{self.session:#0{12}x}"
+                data = codec.dumps(data)
+
+            tail = b"\x00"
+            if version == 0:
+                tail = b"\x0a" + tail
+            pkt = build_packet(
+                msg, data, self.session, self.packet_count, version, tail
             )
-
-        tail = b"\x00"
-        if version == 0:
-            tail = b"\x0a" + tail
-        pkt = (
-            struct.pack(
-                "BB2xII2xHI",
-                255,
-                version,
-                self.session,
-                self.packet_count,
-                msg,
-                len(data) + len(tail),
-            )
-            + data
-            + tail
-        )
-        self.logger.debug("=> %s", pkt)
-        self.socket_send(pkt)
-        if wait_response:
-            reply = {"Ret": 101}
-            data = self.socket_recv(20)
-            if data is None or len(data) < 20:
-                return None
-            (
-                head,
-                version,
-                self.session,
-                sequence_number,
-                msgid,
-                len_data,
-            ) = struct.unpack("BB2xII2xHI", data)
-
-            reply = None
-            if download:
-                reply = self.get_file()
-            elif size:
-                reply = self.get_specific_size(size)
-            self.busy.release()
-            return reply
+            self.logger.debug("=> %s", pkt)
+            self.socket_send(pkt)
+            if wait_response:
+                reply = {"Ret": 101}
+                data = self.socket_recv(HEADER_SIZE)
+                if data is None or len(data) < HEADER_SIZE:
+                    return None
+                self.session = unpack_header(data).session
+
+                reply = None
+                if download:
+                    reply = self.get_file(sink, progress)
+                elif size:
+                    reply = self.get_specific_size(size)
+                return reply
 
     def send(self, msg, data={}, wait_response=True):
         if self.socket is None:
             return {"Ret": 101}
-        # self.busy.wait()
-        self.busy.acquire()
-        if hasattr(data, "__iter__"):
-            data = bytes(json.dumps(data, ensure_ascii=False), "utf-8")
-        pkt = (
-            struct.pack(
-                "BB2xII2xHI",
-                255,
-                0,
-                self.session,
-                self.packet_count,
-                msg,
-                len(data) + 2,
-            )
-            + data
-            + b"\x0a\x00"
-        )
-        self.logger.debug("=> %s", pkt)
-        self.socket_send(pkt)
-        if wait_response:
-            reply = {"Ret": 101}
-            data = self.socket_recv(20)
-            if data is None or len(data) < 20:
+        if self.pending is not None:
+            sequence_number, future = self.queue_request(msg, data)
+            if not wait_response:
                 return None
-            (
-                head,
-                version,
-                self.session,
-                sequence_number,
-                msgid,
-                len_data,
-            ) = struct.unpack("BB2xII2xHI", data)
-            reply = self.receive_json(len_data)
-            self.busy.release()
-            return reply
+            return self.wait_reply(sequence_number, future)
+        with self.busy:
+            if not isinstance(data, (bytes, bytearray)):
+                data = codec.dumps(data)
+            pkt = build_packet(msg, data, self.session, self.packet_count)
+            self.logger.debug("=> %s", pkt)
+            self.socket_send(pkt)
+            if wait_response:
+                reply = {"Ret": 101}
+                data = self.socket_recv(HEADER_SIZE)
+                if data is None or len(data) < HEADER_SIZE:
+                    return None
+                header = unpack_header(data)
+                self.session = header.session
+                reply = self.receive_json(header.length)
+                return reply
+
+    def send_many(self, requests):
+        """Send (msg, data) requests back-to-back and read the replies in order.
+
+        The camera answers a TCP session strictly in order, so the whole
+        batch costs one round-trip instead of one per request. A missing
+        reply is returned as None.
+        """
+        if self.socket is None:
+            return [{"Ret": 101} for request in requests]
+        if self.pending is not None:
+            queued = [self.queue_request(msg, data) for msg, data in requests]
+            return [self.wait_reply(*request) for request in queued]
+        replies = []
+        with self.busy:
+            pkts = []
+            for i, (msg, data) in enumerate(requests):
+                if not isinstance(data, (bytes, bytearray)):
+                    data = codec.dumps(data)
+                pkts.append(build_packet(msg, data, self.session, self.packet_count + i))
+            pkt = b"".join(pkts)
+            self.logger.debug("=> %s", pkt)
+            self.socket_send(pkt)
+            for request in requests:
+                data = self.receive_with_timeout(HEADER_SIZE)
+                if data is None:
+                    break
+                header = unpack_header(data)
+                self.session = header.session
+                replies.append(self.receive_json(header.length))
+        return replies + [None] * (len(requests) - len(replies))
+
+    def start_multiplex(self):
+        """Switch the session to pipelined requests.
+
+        A background reader takes over the socket and hands every reply to
+        the future of the request carrying the same sequence number (falling
+        back to the oldest request waiting for that reply code), so many
+        send_async() calls can be in flight at once. send() and the get_*/
+        set_* helpers keep working as blocking wrappers. A running alarm
+        thread is stopped first, the reader dispatches alarms from then on.
+
+        Everything that reads or writes the socket itself raises
+        SomethingIsWrongWithCamera on a multiplexed session:
+        start_monitor(), iter_frames(), snapshot(), send_custom(),
+        download_file(), channel_bitmap(), upgrade(), talk_start() and
+        talk_send(). Use a second session for those.
+        """
+        if self.socket is None or self.pending is not None:
+            return
+        alarm, self.alarm = self.alarm, None
+        if alarm is not None and alarm is not threading.current_thread():
+            # it leaves its loop once it is no longer self.alarm
+            alarm.join(self.timeout + 1)
+            if alarm.is_alive():
+                self.alarm = alarm
+                raise SomethingIsWrongWithCamera("Alarm thread does not stop")
+        with self.busy:
+            self.pending = OrderedDict()
+            # the reader blocks until close() instead of timing out when idle
+            self.socket.settimeout(None)
+            self.reader = threading.Thread(
+                name="DVRMux%08X" % self.session,
+                target=self.multiplex_thread,
+                args=[self.socket],
+            )
+            self.reader.daemon = True
+            self.reader.start()
+
+    def check_direct(self, what):
+        # the multiplex reader would take the packets these wait for
+        if self.pending is not None:
+            raise SomethingIsWrongWithCamera(f"{what} is not available on a multiplexed session")
+
+    def send_async(self, msg, data={}):
+        """Future of the reply; without one within self.timeout it fails
+        with SomethingIsWrongWithCamera once the next reply arrives."""
+        future = Future()
+        if self.socket is None:
+            future.set_result({"Ret": 101})
+            return future
+        if self.pending is None:
+            future.set_result(self.send(msg, data))
+            return future
+        return self.queue_request(msg, data)[1]
+
+    def queue_request(self, msg, data):
+        future = Future()
+        if not isinstance(data, (bytes, bytearray)):
+            data = codec.dumps(data)
+        with self.send_lock:
+            sequence_number = self.packet_count
+            self.packet_count += 1
+            pkt = build_packet(msg, data, self.session, sequence_number)
+            try:
+                self.pending[sequence_number] = (msg + 1, future, time.monotonic())
+                self.logger.debug("=> %s", pkt)
+                self.socket.sendall(pkt)
+            except (OSError, AttributeError, TypeError):
+                # TypeError: the reader has ended and reset self.pending
+                if self.pending is not None:
+                    self.pending.pop(sequence_number, None)
+                future.set_exception(
+                    SomethingIsWrongWithCamera("Cannot send to camera")
+                )
+        return sequence_number, future
+
+    def wait_reply(self, sequence_number, future):
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            # a late reply must not be taken for the next request
+            with self.send_lock:
+                if self.pending is not None:
+                    self.pending.pop(sequence_number, None)
+            return None
+        except SomethingIsWrongWithCamera:
+            return None
+
+    def take_pending(self, sequence_number, msgid):
+        expired = []
+        future = None
+        with self.send_lock:
+            # requests are queued in order, drop the ones past self.timeout
+            # so the msgid fallback below cannot hand them a newer reply
+            deadline = time.monotonic() - self.timeout
+            while self.pending:
+                key, entry = next(iter(self.pending.items()))
+                if entry[2] > deadline:
+                    break
+                expired.append(self.pending.pop(key)[1])
+            entry = self.pending.get(sequence_number)
+            if entry is not None and entry[0] == msgid:
+                future = self.pending.pop(sequence_number)[1]
+            else:
+                for key, (reply_id, waiting, sent) in self.pending.items():
+                    if reply_id == msgid:
+                        future = self.pending.pop(key)[1]
+                        break
+        for waiting in expired:
+            waiting.set_exception(SomethingIsWrongWithCamera("No reply from camera"))
+        if future is None:
+            self.logger.debug("Dropping unmatched reply %d (sequence %d)", msgid, sequence_number)
+        return future
+
+    def multiplex_thread(self, sock):
+        header_view = memoryview(self.header_buf)
+        while self.socket is sock:
+            if not self.receive_into(header_view):
+                break
+            header = unpack_header(self.header_buf)
+            data = self.receive_with_timeout(header.length)
+            if data is None:
+                break
+            self.logger.debug("<= %s", data)
+            try:
+                reply = codec.loads(data[:-2])
+            except ValueError:
+                reply = {"Ret": 101}
+            if (
+                header.msgid == self.QCODES["AlarmInfo"]
+                and header.session == self.session
+            ):
+                alarm = reply.get(reply.get("Name"))
+                if self.alarm_func is not None and alarm is not None:
+                    self.alarm_func(alarm, header.sequence)
+                continue
+            future = self.take_pending(header.sequence, header.msgid)
+            if future is not None:
+                future.set_result(reply)
+        with self.send_lock:
+            pending, self.pending = self.pending, None
+        for reply_id, future, sent in pending.values():
+            future.set_exception(SomethingIsWrongWithCamera("Connection lost"))
+        if self.socket is sock:
+            # the camera went away, close() was not called
+            self.session_dead()
 
     def sofia_hash(self, password=""):
         md5 = hashlib.md5(bytes(password, "utf-8")).digest()
@@ -296,6 +813,11 @@ class DVRIPCam(object):
         return "".join([chars[sum(x) % 62] for x in zip(md5[::2], md5[1::2])])
 
     def login(self):
+        # an explicit login reopens a session after close() or reboot()
+        self.stopped.clear()
+        return self.authenticate()
+
+    def authenticate(self):
         if self.socket is None:
             self.connect()
         data = self.send(
@@ -311,9 +833,65 @@ class DVRIPCam(object):
             return False
         self.session = int(data["SessionID"], 16)
         self.alive_time = data["AliveInterval"]
+        self.generation += 1
         self.keep_alive()
         return data["Ret"] in self.OK_CODES
 
+    def reconnect(self, generation=None):
+        """Log in again after the session dropped, following the ReconnectPolicy.
+
+        ``generation`` is the value of self.generation seen by the caller
+        when the session failed; if another thread already reconnected
+        since then, this just returns. authenticate() restarts the
+        keep-alive, the alarm subscription and multiplexing are re-issued
+        here, and start_monitor() claims its stream again itself. A close()
+        at any point ends it. Returns True once the session is back.
+        """
+        policy = self.reconnect_policy
+        if policy is None or self.stopped.is_set():
+            return False
+        with self.reconnect_lock:
+            if generation is not None and generation != self.generation:
+                return self.socket is not None
+            if self.stopped.is_set():
+                return False
+            closes = self.closes
+            multiplexed = self.reader is not None
+            self.disconnect()
+            if self.reader is not None:
+                self.reader.join(self.timeout)
+                self.reader = None
+            if self.alarm is not None:
+                self.alarm.join(self.timeout)
+            lost = time.time()
+            policy.notify(self, "lost")
+            attempt = 0
+            for delay in policy.delays():
+                if delay:
+                    policy.notify(self, "retry", attempt=attempt + 1, delay=delay)
+                if self.stopped.wait(delay):
+                    break
+                attempt += 1
+                try:
+                    if self.authenticate():
+                        break
+                except SomethingIsWrongWithCamera:
+                    pass
+                self.disconnect()
+            else:
+                policy.notify(self, "failed", attempts=attempt, outage=time.time() - lost)
+                return False
+            # close() may have run while authenticate() was in flight
+            if self.closes != closes:
+                self.disconnect()
+                return False
+            if multiplexed:
+                self.start_multiplex()
+            if self.alarm_subscribed:
+                self.alarmStart()
+            policy.notify(self, "restored", attempts=attempt, outage=time.time() - lost)
+            return True
+
     def getAuthorityList(self):
         data = self.send(self.QCODES["AuthorityList"])
         if data["Ret"] in self.OK_CODES:
@@ -468,19 +1046,12 @@ class DVRIPCam(object):
         )
 
     def channel_bitmap(self, width, height, bitmap):
+        self.check_direct("channel_bitmap()")
         header = struct.pack("HH12x", width, height)
         self.socket_send(
-            struct.pack(
-                "BB2xII2xHI",
-                255,
-                0,
-                self.session,
-                self.packet_count,
-                0x041A,
-                len(bitmap) + 16,
+            build_packet(
+                0x041A, header + bitmap, self.session, self.packet_count, tail=b""
             )
-            + header
-            + bitmap
         )
         reply, rcvd = self.recv_json()
         if reply and reply["Ret"] != 100:
@@ -498,38 +1069,54 @@ class DVRIPCam(object):
         self.alarm_func = None
 
     def alarmStart(self):
-        self.alarm = threading.Thread(
-            name="DVRAlarm%08X" % self.session,
-            target=self.alarm_thread,
-            args=[self.busy],
-        )
-        self.alarm.start()
-        return self.get_command("", self.QCODES["AlarmSet"])
+        self.alarm_subscribed = True
+        # subscribe before the alarm thread starts reading the socket, so
+        # the reply is not swallowed by it
+        reply = self.get_command("", self.QCODES["AlarmSet"], use_cache=False)
+        # in multiplex mode alarms are dispatched by the reader thread
+        if self.pending is None and (self.alarm is None or not self.alarm.is_alive()):
+            self.alarm = threading.Thread(
+                name="DVRAlarm%08X" % self.session,
+                target=self.alarm_thread,
+                args=[self.busy, self.socket],
+            )
+            self.alarm.start()
+        return reply
 
-    def alarm_thread(self, event):
+    def alarm_thread(self, event, sock=None):
         while True:
+            # wait for data without the lock, so send() and the keep-alive
+            # get their turn on an idle socket
+            try:
+                if not select([sock], [], [], self.timeout)[0]:
+                    if self.socket is not sock or self.alarm is not threading.current_thread():
+                        break
+                    continue
+            except (OSError, ValueError, TypeError):
+                break
             event.acquire()
             try:
-                (
-                    head,
-                    version,
-                    session,
-                    sequence_number,
-                    msgid,
-                    len_data,
-                ) = struct.unpack("BB2xII2xHI", self.socket_recv(20))
+                if not select([sock], [], [], 0)[0]:
+                    # it was the reply of a send() holding the lock
+                    continue
+                header = unpack_header(self.socket_recv(HEADER_SIZE))
                 sleep(0.1)  # Just for receive whole packet
-                reply = self.socket_recv(len_data)
+                reply = self.socket_recv(header.length)
                 self.packet_count += 1
-                reply = json.loads(reply[:-2])
-                if msgid == self.QCODES["AlarmInfo"] and self.session == session:
+                reply = codec.loads(reply[:-2])
+                if (
+                    header.msgid == self.QCODES["AlarmInfo"]
+                    and self.session == header.session
+                ):
                     if self.alarm_func is not None:
-                        self.alarm_func(reply[reply["Name"]], sequence_number)
+                        self.alarm_func(reply[reply["Name"]], header.sequence)
             except:
                 pass
             finally:
                 event.release()
-            if self.socket is None:
+            if self.socket is None or self.socket is not sock:
+                break
+            if self.alarm is not threading.current_thread():
                 break
 
     def set_remote_alarm(self, state):
@@ -539,16 +1126,24 @@ class DVRIPCam(object):
         )
 
     def keep_alive(self):
-        ret = self.send(
-            self.QCODES["KeepAlive"],
-            {"Name": "KeepAlive", "SessionID": "0x%08X" % self.session},
-        )
-        if ret is None:
+        if self.alive is not None:
+            self.alive.cancel()
+        scheduler = self.keepalive_scheduler or KeepAliveScheduler.get_default()
+        self.alive = scheduler.register(self, self.alive_time)
+
+    def session_dead(self):
+        if self.reconnect_policy is None:
             self.close()
             return
-        self.alive = threading.Timer(self.alive_time, self.keep_alive)
-        self.alive.daemon = True
-        self.alive.start()
+        generation = self.generation
+        self.disconnect()
+        thread = threading.Thread(
+            name="DVRReconnect%s" % self.ip,
+            target=self.reconnect,
+            args=[generation],
+        )
+        thread.daemon = True
+        thread.start()
 
     def keyDown(self, key):
         self.set_command(
@@ -621,14 +1216,29 @@ class DVRIPCam(object):
                 code = code.get("SET")
         if not code:
             code = self.QCODES[command]
+        if self.cache is not None:
+            self.cache.invalidate(command)
         return self.send(
             code, {"Name": command, "SessionID": "0x%08X" % self.session, command: data}
         )
 
-    def get_info(self, command):
-        return self.get_command(command, 1042)
+    def enable_cache(self, ttl=60, ttls=None):
+        """Cache get_command/get_info replies, see ResponseCache."""
+        self.cache = ResponseCache(ttl, ttls)
+        return self.cache
+
+    def disable_cache(self):
+        self.cache = None
 
-    def get_command(self, command, code=None):
+    def cache_stats(self):
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def get_info(self, command, use_cache=True):
+        return self.get_command(command, 1042, use_cache)
+
+    def get_command(self, command, code=None, use_cache=True):
         if not code:
             code = self.OPFEED_QCODES.get(command)
             if code:
@@ -636,12 +1246,112 @@ class DVRIPCam(object):
         if not code:
             code = self.QCODES[command]
 
-        data = self.send(code, {"Name": command, "SessionID": "0x%08X" % self.session})
-        if data["Ret"] in self.OK_CODES and command in data:
+        cache = self.cache if use_cache else None
+        if cache is not None:
+            found, value = cache.get(command, code)
+            if found:
+                return value
+
+        data = self.send(code, templates.command(command).render(self.session))
+        if data is not None and data["Ret"] in self.OK_CODES and command in data:
+            if cache is not None:
+                cache.put(command, code, data[command])
             return data[command]
         else:
             return data
 
+    def set_info_many(self, mapping):
+        """Write several config keys in one batch, see send_many().
+
+        Returns (replies, errors): the reply of every key, and the reply
+        (None when the camera did not answer) of every key that failed.
+        """
+        if self.cache is not None:
+            for command in mapping:
+                self.cache.invalidate(command)
+        names = list(mapping)
+        session = "0x%08X" % self.session
+        replies = self.send_many(
+            [
+                (1040, {"Name": name, "SessionID": session, name: mapping[name]})
+                for name in names
+            ]
+        )
+        results = {}
+        errors = {}
+        for name, reply in zip(names, replies):
+            results[name] = reply
+            if reply is None or reply.get("Ret") not in self.OK_CODES:
+                errors[name] = reply
+        return results, errors
+
+    def get_info_many(self, names, use_cache=True):
+        """Read several config keys in one batch, see send_many().
+
+        Returns (results, errors): the value of every key read successfully,
+        and the reply (None when the camera did not answer) of every key that
+        failed.
+        """
+        results = {}
+        errors = {}
+        cache = self.cache if use_cache else None
+        missing = []
+        for name in names:
+            if cache is not None:
+                found, value = cache.get(name, 1042)
+                if found:
+                    results[name] = value
+                    continue
+            missing.append(name)
+        replies = self.send_many(
+            [(1042, templates.command(name).render(self.session)) for name in missing]
+        )
+        for name, reply in zip(missing, replies):
+            if reply is not None and reply.get("Ret") in self.OK_CODES and name in reply:
+                results[name] = reply[name]
+                if cache is not None:
+                    cache.put(name, 1042, reply[name])
+            else:
+                errors[name] = reply
+        return results, errors
+
+    def get_info_async(self, command, use_cache=True):
+        return self.get_command_async(command, 1042, use_cache)
+
+    def get_command_async(self, command, code=None, use_cache=True):
+        if not code:
+            code = self.OPFEED_QCODES.get(command)
+            if code:
+                code = code.get("GET")
+        if not code:
+            code = self.QCODES[command]
+
+        result = Future()
+        cache = self.cache if use_cache else None
+        if cache is not None:
+            found, value = cache.get(command, code)
+            if found:
+                result.set_result(value)
+                return result
+
+        def unpack(future):
+            try:
+                data = future.result()
+            except Exception as e:
+                result.set_exception(e)
+                return
+            if data["Ret"] in self.OK_CODES and command in data:
+                if cache is not None:
+                    cache.put(command, code, data[command])
+                result.set_result(data[command])
+            else:
+                result.set_result(data)
+
+        self.send_async(
+            code, templates.command(command).render(self.session)
+        ).add_done_callback(unpack)
+        return result
+
     def get_time(self):
         return datetime.strptime(self.get_command("OPTimeQuery"), self.DATE_FORMAT)
 
@@ -653,17 +1363,17 @@ class DVRIPCam(object):
     def get_netcommon(self):
         return self.get_command("NetWork.NetCommon")
 
-    def get_system_info(self):
-        return self.get_command("SystemInfo")
+    def get_system_info(self, use_cache=True):
+        return self.get_command("SystemInfo", use_cache=use_cache)
 
-    def get_general_info(self):
-        return self.get_command("General")
+    def get_general_info(self, use_cache=True):
+        return self.get_command("General", use_cache=use_cache)
 
-    def get_encode_capabilities(self):
-        return self.get_command("EncodeCapability")
+    def get_encode_capabilities(self, use_cache=True):
+        return self.get_command("EncodeCapability", use_cache=use_cache)
 
-    def get_system_capabilities(self):
-        return self.get_command("SystemFunction")
+    def get_system_capabilities(self, use_cache=True):
+        return self.get_command("SystemFunction", use_cache=use_cache)
 
     def get_camera_info(self, default_config=False):
         """Request data for 'Camera' from  the target DVRIP device."""
@@ -696,12 +1406,13 @@ class DVRIPCam(object):
         if m is None:
             return None, buf
         buf = buf[m.span(1)[1] :]
-        return json.loads(m.group(1)), buf
+        return codec.loads(m.group(1)), buf
 
     def get_upgrade_info(self):
         return self.get_command("OPSystemUpgrade")
 
     def upgrade(self, filename="", packetsize=0x8000, vprint=None):
+        self.check_direct("upgrade()")
         if not vprint:
             vprint = lambda x: print(x)
 
@@ -721,10 +1432,9 @@ class DVRIPCam(object):
                 bytes = f.read(packetsize)
                 if not bytes:
                     break
-                header = struct.pack(
-                    "BB2xII2xHI", 255, 0, self.session, blocknum, 0x5F2, len(bytes)
+                self.socket_send(
+                    build_packet(0x5F2, bytes, self.session, blocknum, tail=b"")
                 )
-                self.socket_send(header + bytes)
                 blocknum += 1
                 sentbytes += len(bytes)
 
@@ -737,7 +1447,7 @@ class DVRIPCam(object):
                 vprint(f"Uploaded {progress:.2f}%")
         vprint("End of file")
 
-        pkt = struct.pack("BB2xIIxBHI", 255, 0, self.session, blocknum, 1, 0x05F2, 0)
+        pkt = pack_header(0x05F2, 0, self.session, blocknum, cur=1)
         self.socket_send(pkt)
         vprint("Waiting for upgrade...")
         while True:
@@ -763,11 +1473,27 @@ class DVRIPCam(object):
                 return data
             vprint(f"Upgraded {data['Ret']}%")
 
-    def get_file(self):
+    def get_file(self, sink=None, progress=None):
+        """Receive a playback download.
+
+        Without ``sink`` the whole file is returned as a bytearray. Otherwise
+        every packet is handed to ``sink`` as it arrives: a file-like object
+        (write), a started generator (send) or a callable. The chunk is a
+        memoryview of a receive buffer that is reused for the next packet,
+        so memory stays constant; copy it to keep it. ``progress(received)``
+        is called after every packet. Returns the number of bytes received,
+        or raises SomethingIsWrongWithCamera if the download broke off.
+        """
         # recorded with 15 (0x0F) fps
+        if sink is None:
+            buf = bytearray()
+            self.get_file(buf.extend, progress)
+            return buf
+        write = getattr(sink, "write", None) or getattr(sink, "send", None) or sink
 
-        buf = bytearray()
         data = self.receive_with_timeout(16)
+        if data is None:
+            raise SomethingIsWrongWithCamera("Download did not start")
         (
             static,
             dyn1,
@@ -776,104 +1502,51 @@ class DVRIPCam(object):
         ) = struct.unpack("IIII", data)
         file_length = len_data
 
-        data = self.receive_with_timeout(8176)
-        buf.extend(data)
-
+        len_data = 8176
+        received = 0
+        buf = bytearray(0x10000)
         while True:
-            header = self.receive_with_timeout(20)
-            len_data = struct.unpack("I", header[16:])[0]
-
+            if len_data > len(buf):
+                buf = bytearray(len_data)
+            view = memoryview(buf)[:len_data]
+            if not self.receive_into(view):
+                raise SomethingIsWrongWithCamera("Download broke off")
+            write(view)
+            received += len_data
+            if progress is not None:
+                progress(received)
+
+            header = self.receive_with_timeout(HEADER_SIZE)
+            if header is None:
+                raise SomethingIsWrongWithCamera("Download broke off")
+            len_data = unpack_header(header).length
             if len_data == 0:
-                return buf
-
-            data = self.receive_with_timeout(len_data)
-            buf.extend(data)
+                return received
 
     def get_specific_size(self, size):
         return self.receive_with_timeout(size)
 
     def reassemble_bin_payload(self, metadata={}):
-        def internal_to_type(data_type, value):
-            if data_type == 0x1FC or data_type == 0x1FD:
-                if value == 1:
-                    return "mpeg4"
-                elif value == 2:
-                    return "h264"
-                elif value == 3:
-                    return "h265"
-            elif data_type == 0x1F9:
-                if value == 1 or value == 6:
-                    return "info"
-            elif data_type == 0x1FA:
-                if value == 0xE:
-                    return "g711a"
-            elif data_type == 0x1FE and value == 0:
-                return "jpeg"
-            return None
-
-        def internal_to_datetime(value):
-            second = value & 0x3F
-            minute = (value & 0xFC0) >> 6
-            hour = (value & 0x1F000) >> 12
-            day = (value & 0x3E0000) >> 17
-            month = (value & 0x3C00000) >> 22
-            year = ((value & 0xFC000000) >> 26) + 2000
-            return datetime(year, month, day, hour, minute, second)
-
         length = 0
         buf = bytearray()
         start_time = time.time()
 
         while True:
-            data = self.receive_with_timeout(20)
-            (
-                head,
-                version,
-                session,
-                sequence_number,
-                total,
-                cur,
-                msgid,
-                len_data,
-            ) = struct.unpack("BB2xIIBBHI", data)
-            packet = self.receive_with_timeout(len_data)
+            data = self.receive_with_timeout(HEADER_SIZE)
+            if data is None:
+                return None
+            packet = self.receive_with_timeout(unpack_header(data).length)
+            if packet is None:
+                return None
             frame_len = 0
             if length == 0:
-                media = None
-                frame_len = 8
-                (data_type,) = struct.unpack(">I", packet[:4])
-                if data_type == 0x1FC or data_type == 0x1FE:
-                    frame_len = 16
-                    (
-                        media,
-                        metadata["fps"],
-                        w,
-                        h,
-                        dt,
-                        length,
-                    ) = struct.unpack("BBBBII", packet[4:frame_len])
-                    metadata["width"] = w * 8
-                    metadata["height"] = h * 8
-                    metadata["datetime"] = internal_to_datetime(dt)
-                    if data_type == 0x1FC:
-                        metadata["frame"] = "I"
-                elif data_type == 0x1FD:
-                    (length,) = struct.unpack("I", packet[4:frame_len])
-                    metadata["frame"] = "P"
-                elif data_type == 0x1FA:
-                    (media, samp_rate, length) = struct.unpack(
-                        "BBH", packet[4:frame_len]
-                    )
-                elif data_type == 0x1F9:
-                    (media, n, length) = struct.unpack("BBH", packet[4:frame_len])
+                (data_type,) = MEDIA_TYPE.unpack_from(packet)
                 # special case of JPEG shapshots
-                elif data_type == 0xFFD8FFE0:
+                if data_type == JPEG:
                     return packet
-                else:
-                    raise ValueError(data_type)
-                if media is not None:
-                    metadata["type"] = internal_to_type(data_type, media)
-            buf.extend(packet[frame_len:])
+                frame_len = media_header_size(data_type)
+                length = parse_media_header(data_type, packet, metadata)
+            buf.extend(memoryview(packet)[frame_len:])
             length -= len(packet) - frame_len
             if length == 0:
                 return buf
@@ -881,61 +1554,340 @@ class DVRIPCam(object):
             if elapsed_time > self.timeout:
                 return None
 
+    def receive_frame(self, metadata=None, arena=None):
+        """Receive one media frame straight into a pooled arena block.
+
+        Same framing as reassemble_bin_payload, but every packet body is read
+        with recv_into at its final offset, so the frame bytes are copied only
+        once from the kernel. Returns an ArenaBuffer the caller must release().
+        """
+        if metadata is None:
+            metadata = {}
+        if arena is None:
+            if self.arena is None:
+                self.arena = BufferArena()
+            arena = self.arena
+        header = memoryview(self.header_buf)
+        media = memoryview(self.media_buf)
+        frame = None
+        length = 0
+        received = 0
+        start_time = time.time()
+
+        try:
+            while True:
+                if not self.receive_into(header):
+                    break
+                len_data = unpack_header(self.header_buf).length
+                if frame is None:
+                    if not self.receive_into(media[:8]):
+                        break
+                    (data_type,) = MEDIA_TYPE.unpack_from(self.media_buf)
+                    # special case of JPEG shapshots
+                    if data_type == JPEG:
+                        frame = arena.acquire(len_data)
+                        frame.view[:8] = media[:8]
+                        if self.receive_into(frame.view[8:]):
+                            return frame
+                        break
+                    frame_len = media_header_size(data_type)
+                    if frame_len > 8 and not self.receive_into(media[8:]):
+                        break
+                    length = parse_media_header(data_type, media, metadata)
+                    frame = arena.acquire(length)
+                    len_data -= frame_len
+                if len_data > length - received:
+                    raise ValueError("Media packet overruns its frame")
+                if not self.receive_into(frame.view[received : received + len_data]):
+                    break
+                received += len_data
+                if received == length:
+                    return frame
+                elapsed_time = time.time() - start_time
+                if elapsed_time > self.timeout:
+                    break
+        except:
+            if frame is not None:
+                frame.release()
+            raise
+        if frame is not None:
+            frame.release()
+        return None
+
     def snapshot(self, channel=0):
+        self.check_direct("snapshot()")
         command = "OPSNAP"
-        self.send(
-            self.QCODES[command],
-            {
-                "Name": command,
-                "SessionID": "0x%08X" % self.session,
-                command: {"Channel": channel},
-            },
-            wait_response=False,
-        )
-        packet = self.reassemble_bin_payload()
+        with self.busy:
+            self.send(
+                self.QCODES[command],
+                {
+                    "Name": command,
+                    "SessionID": "0x%08X" % self.session,
+                    command: {"Channel": channel},
+                },
+                wait_response=False,
+            )
+            packet = self.reassemble_bin_payload()
         return packet
 
-    def start_monitor(self, frame_callback, user={}, stream="Main"):
-        params = {
-            "Channel": 0,
+    def monitor_params(self, channel=0, stream="Main"):
+        return {
+            "Channel": channel,
             "CombinMode": "NONE",
             "StreamType": stream,
             "TransMode": "TCP",
         }
+
+    def monitor_claim(self, params):
+        self.check_direct("Monitoring")
+        generation = self.generation
         data = self.set_command("OPMonitor", {"Action": "Claim", "Parameter": params})
-        if data["Ret"] not in self.OK_CODES:
-            return data
+        if data is None and self.reconnect(generation):
+            return self.monitor_claim(params)
+        return data
 
+    def monitor_command(self, action, params):
         self.send(
             1410,
             {
                 "Name": "OPMonitor",
                 "SessionID": "0x%08X" % self.session,
-                "OPMonitor": {"Action": "Start", "Parameter": params},
+                "OPMonitor": {"Action": action, "Parameter": params},
             },
             wait_response=False,
         )
-        self.monitoring = True
+
+    def stop_stream(self, params, quiet=0.5):
+        """Stop a running stream and discard the packets still in flight.
+
+        Returns False if the socket did not go quiet, then the session can
+        no longer be used for requests.
+        """
+        self.monitor_command("Stop", params)
+        return self.drain(quiet)
+
+    def drain(self, quiet=0.5):
+        """Discard incoming data until the socket is ``quiet`` for a while."""
+        try:
+            self.socket.settimeout(quiet)
+            while self.socket.recv(0x10000):
+                pass
+            return False
+        except SocketTimeout:
+            return True
+        except (OSError, AttributeError):
+            return False
+        finally:
+            try:
+                self.socket.settimeout(self.timeout)
+            except (OSError, AttributeError):
+                pass
+
+    def monitor_frames(self, params, arena=None):
+        """Yield (frame, metadata) of a claimed stream until stop_monitor().
+
+        The stream owns the socket, so the session lock is held while it
+        runs. A broken stream is claimed again after a reconnect; closing
+        the generator stops the stream on the camera. In zero-copy mode the
+        frame is an ArenaBuffer that is recycled once the consumer asks for
+        the next frame unless it was retain()ed.
+        """
         while self.monitoring:
-            meta = {}
-            frame = self.reassemble_bin_payload(meta)
-            frame_callback(frame, meta, user)
+            generation = self.generation
+            broken = False
+            with self.busy:
+                self.monitor_command("Start", params)
+                try:
+                    while self.monitoring:
+                        meta = {}
+                        if arena is None:
+                            frame = self.reassemble_bin_payload(meta)
+                        else:
+                            frame = self.receive_frame(meta, arena)
+                        if frame is None:
+                            # a timeout after stop_monitor() is not an error
+                            broken = self.monitoring
+                            break
+                        try:
+                            yield frame, meta
+                        finally:
+                            if arena is not None:
+                                frame.release()
+                finally:
+                    if not broken and not self.stop_stream(params):
+                        self.session_dead()
+            if not broken:
+                return
+            # claim the stream again on a new session; the session lock is
+            # released first so a reconnect in progress can log in
+            if not self.reconnect(generation):
+                self.monitoring = False
+                raise SomethingIsWrongWithCamera("Media stream lost")
+            data = self.monitor_claim(params)
+            if data is None or data["Ret"] not in self.OK_CODES:
+                self.monitoring = False
+                raise SomethingIsWrongWithCamera("Cannot claim the stream again")
+
+    def read_ahead(self, frames, queue, arena=None):
+        """Read (frame, metadata) from ``frames`` on a separate thread.
+
+        The reader thread keeps draining the socket into the FrameQueue, so
+        a slow consumer costs dropped frames according to the queue policy
+        instead of stalling the camera. Errors of the reader are raised
+        here once the queue is drained.
+        """
+        errors = []
+        if arena is not None and queue.discard is None:
+            queue.discard = lambda item: item[0].release()
+        reader = threading.Thread(
+            name="DVRMonitor%08X" % self.session,
+            target=self.monitor_reader,
+            args=[frames, queue, arena, errors],
+        )
+        reader.daemon = True
+        reader.start()
+        try:
+            for item in queue:
+                try:
+                    yield item
+                finally:
+                    if arena is not None:
+                        item[0].release()
+        finally:
+            self.monitoring = False
+            queue.close(discard=True)
+            reader.join()
+        if errors:
+            raise errors[0]
+
+    def monitor_reader(self, frames, queue, arena, errors):
+        try:
+            for frame, meta in frames:
+                if arena is not None:
+                    frame.retain()
+                if not queue.put((frame, meta), meta.get("frame")):
+                    if arena is not None:
+                        frame.release()
+                    break
+        except Exception as e:
+            errors.append(e)
+        finally:
+            frames.close()
+            queue.close()
+
+    def start_monitor(
+        self, frame_callback, user={}, stream="Main", arena=None, queue=None, channel=0
+    ):
+        params = self.monitor_params(channel, stream)
+        data = self.monitor_claim(params)
+        if data is None or data["Ret"] not in self.OK_CODES:
+            return data
+        self.monitoring = True
+        frames = self.monitor_frames(params, arena)
+        if queue is not None:
+            # the callback runs here, the socket is read by another thread
+            frames = self.read_ahead(frames, queue, arena)
+        with closing(frames) as frames:
+            for frame, meta in frames:
+                frame_callback(frame, meta, user)
+                if not self.monitoring:
+                    break
+
+    def iter_frames(self, channel=0, stream="Main", arena=None, queue=None, pcm=False):
+        """Generator of Frame records of a live stream.
+
+        Closing the generator (or leaving the for loop) stops the stream,
+        so the session can be used for requests again. With an ``arena``
+        the payload is an ArenaBuffer valid until the next frame is taken.
+        With a dvrip_queue.FrameQueue the socket is read ahead on a
+        separate thread, see read_ahead(). With ``pcm`` audio frames are
+        decoded to 16 bit PCM, see dvrip_audio.
+        """
+        params = self.monitor_params(channel, stream)
+        data = self.monitor_claim(params)
+        if data is None or data["Ret"] not in self.OK_CODES:
+            raise SomethingIsWrongWithCamera("Cannot claim the stream")
+        self.monitoring = True
+        video = {}
+        frames = self.monitor_frames(params, arena)
+        if queue is not None:
+            frames = self.read_ahead(frames, queue, arena)
+        with closing(frames) as frames:
+            for frame, meta in frames:
+                frame = make_frame(frame, meta, video, channel, stream)
+                yield pcm_frame(frame) if pcm else frame
+
+    def talk_start(self, law="alaw"):
+        """Claim the speaker of the camera for talk_send()."""
+        self.check_direct("talk_start()")
+        audio = {
+            "BitRate": 128,
+            "EncodeType": ENCODE_TYPES[law],
+            "SampleBit": 8,
+            "SampleRate": SAMPLE_RATE,
+        }
+        for msg, action in ((self.QCODES["OPTalk"], "Claim"), (1430, "Start")):
+            data = self.send(
+                msg,
+                {
+                    "Name": "OPTalk",
+                    "SessionID": "0x%08X" % self.session,
+                    "OPTalk": {"Action": action, "AudioFormat": audio},
+                },
+            )
+            if data is None or data.get("Ret") not in self.OK_CODES:
+                return False
+        self.talk_law = law
+        return True
+
+    def talk_send(self, data, pcm=True, realtime=True):
+        """Play ``data`` on the speaker after talk_start().
+
+        ``data`` is 16 bit PCM at 8 kHz, or G.711 of the claimed law with
+        ``pcm`` False. With ``realtime`` packets are paced to the playback
+        rate so the camera buffer does not overflow.
+        """
+        self.check_direct("talk_send()")
+        if pcm:
+            data = encode(data, self.talk_law)
+        chunk = 320  # 40 ms
+        start = time.monotonic()
+        for i, payload in enumerate(talk_packets(data, self.talk_law, chunk)):
+            if realtime:
+                delay = start + i * chunk / SAMPLE_RATE - time.monotonic()
+                if delay > 0:
+                    sleep(delay)
+            with self.busy:
+                self.socket_send(build_packet(1432, payload, self.session, self.packet_count, tail=b""))
+
+    def talk_stop(self, quiet=0.5):
+        self.send(
+            1430,
+            {
+                "Name": "OPTalk",
+                "SessionID": "0x%08X" % self.session,
+                "OPTalk": {"Action": "Stop"},
+            },
+            wait_response=False,
+        )
+        # the camera may have sent microphone audio meanwhile
+        with self.busy:
+            return self.drain(quiet)
 
     def stop_monitor(self):
         self.monitoring = False
 
-    def list_local_files(self, startTime, endTime, filetype):
+    def file_query(self, begin, end, filetype, channel=0):
         # 1440 OPFileQuery
-        result = []
-        data = self.send(
+        return (
             1440,
             {
                 "Name": "OPFileQuery",
                 "OPFileQuery": {
-                    "BeginTime": startTime,
-                    "Channel": 0,
+                    "BeginTime": begin.strftime(TIME_FORMAT),
+                    "Channel": channel,
                     "DriverTypeMask": "0x0000FFFF",
-                    "EndTime": endTime,
+                    "EndTime": end.strftime(TIME_FORMAT),
                     "Event": "*",
                     "StreamType": "0x00000000",
                     "Type": filetype,
@@ -943,57 +1895,62 @@ class DVRIPCam(object):
             },
         )
 
-        if data == None or data["Ret"] != 100:
-            self.logger.debug("Could not get files.")
-            raise ConnectionRefusedError("Could not get files")
+    def iter_local_files(self, startTime, endTime, filetype, channel=0, batch=32):
+        """Generator of the recorded files between startTime and endTime.
 
-        # When no file can be found for the query OPFileQuery is None
-        if data["OPFileQuery"] == None:
+        A reply holds at most the first 64 files of its window by BeginTime.
+        When a window is full, the rest of it from the BeginTime of its last
+        file on is split into sub-windows sized by the file density seen in
+        the reply, and up to ``batch`` windows are queried back-to-back with
+        send_many(). Listing many files thus costs a few round-trips. Files
+        are yielded once per FileName as soon as their window is answered.
+        """
+        limit = 64
+        seen = set()
+        windows = [
+            (
+                datetime.strptime(startTime, TIME_FORMAT),
+                datetime.strptime(endTime, TIME_FORMAT),
+            )
+        ]
+        while windows:
+            todo, windows = windows[:batch], windows[batch:]
+            replies = self.send_many(
+                [self.file_query(begin, end, filetype, channel) for begin, end in todo]
+            )
+            for (begin, end), data in zip(todo, replies):
+                if data is None or data.get("Ret") != 100:
+                    self.logger.debug("Could not get files.")
+                    raise ConnectionRefusedError("Could not get files")
+                # When no file can be found for the query OPFileQuery is None
+                files = data.get("OPFileQuery") or []
+                for file in files:
+                    if file["FileName"] not in seen:
+                        seen.add(file["FileName"])
+                        yield file
+                if len(files) < limit:
+                    continue
+                last = datetime.strptime(files[-1]["BeginTime"], TIME_FORMAT)
+                if last <= begin:
+                    self.logger.warning(
+                        f"More than {limit} files start at {begin}, some are missing"
+                    )
+                    last = begin + timedelta(seconds=1)
+                if last > end:
+                    continue
+                rest = (end - last).total_seconds()
+                density = len(files) / max((last - begin).total_seconds(), 1)
+                # aim at 3/4 full windows so that few of them need a split again
+                parts = int(min(max(density * rest / (limit * 3 // 4) + 1, 2), limit, rest + 1))
+                bounds = sorted({last + timedelta(seconds=int(rest * i / parts)) for i in range(parts + 1)})
+                windows += list(zip(bounds, bounds[1:])) or [(last, end)]
+
+    def list_local_files(self, startTime, endTime, filetype, channel=0):
+        result = list(self.iter_local_files(startTime, endTime, filetype, channel))
+        if not result:
             self.logger.debug(
                 f"No files found for this range. Start: {startTime}, End: {endTime}"
             )
-            return []
-
-        # OPFileQuery only returns the first 64 items
-        # we therefore need to add the results to a list, modify the starttime with the begintime value of the last item we received and query again
-        # max number of results are 511
-        result = data["OPFileQuery"]
-
-        max_event = {"status": "init", "last_num_results": 0}
-        while max_event["status"] == "init" or max_event["status"] == "limit":
-            if max_event["status"] == "init":
-                max_event["status"] = "run"
-            while len(data["OPFileQuery"]) == 64 or max_event["status"] == "limit":
-                newStartTime = data["OPFileQuery"][-1]["BeginTime"]
-                data = self.send(
-                    1440,
-                    {
-                        "Name": "OPFileQuery",
-                        "OPFileQuery": {
-                            "BeginTime": newStartTime,
-                            "Channel": 0,
-                            "DriverTypeMask": "0x0000FFFF",
-                            "EndTime": endTime,
-                            "Event": "*",
-                            "StreamType": "0x00000000",
-                            "Type": filetype,
-                        },
-                    },
-                )
-                result += data["OPFileQuery"]
-                max_event["status"] = "run"
-
-            if len(result) % 511 == 0 or max_event["status"] == "limit":
-                self.logger.debug("Max number of events reached...")
-                if len(result) == max_event["last_num_results"]:
-                    self.logger.debug(
-                        "No new events since last run. All events queried"
-                    )
-                    return result
-
-                max_event["status"] = "limit"
-                max_event["last_num_results"] = len(result)
-
         self.logger.debug(f"Found {len(result)} files.")
         return result
 
@@ -1028,20 +1985,13 @@ class DVRIPCam(object):
 
         self.set_command("OPPTZControl", {"Command": cmd, "Parameter": parms_end})
 
-    def download_file(
-        self, startTime, endTime, filename, targetFilePath, download=True
-    ):
-        Path(targetFilePath).parent.mkdir(parents=True, exist_ok=True)
-
-        self.logger.debug(f"Downloading: {targetFilePath}")
-
-        self.send(
-            1424,
-            {
-                "Name": "OPPlayBack",
-                "OPPlayBack": {
-                    "Action": "Claim",
-                    "Parameter": {
+    def playback_params(self, filename, startTime, endTime, action, **parameter):
+        return {
+            "Name": "OPPlayBack",
+            "OPPlayBack": {
+                "Action": action,
+                "Parameter": dict(
+                    {
                         "PlayMode": "ByName",
                         "FileName": filename,
                         "StreamType": 0,
@@ -1049,75 +1999,95 @@ class DVRIPCam(object):
                         "TransMode": "TCP",
                         # Maybe IntelligentPlayBack is needed in some edge case
                         # "IntelligentPlayBackEvent": "",
-                        # "IntelligentPlayBackSpeed": 2031619,
+                        # "IntelligentPlayBackSpeed": 0,
                     },
-                    "StartTime": startTime,
-                    "EndTime": endTime,
-                },
+                    **parameter,
+                ),
+                "StartTime": startTime,
+                "EndTime": endTime,
             },
-        )
+        }
+
+    def download_file(
+        self,
+        startTime,
+        endTime,
+        filename,
+        targetFilePath,
+        download=True,
+        sink=None,
+        progress=None,
+        resume=False,
+        by_time=False,
+        channel=None,
+    ):
+        """Download a recorded file, writing it to disk as it arrives.
+
+        The data goes to ``targetFilePath.part``, which is renamed when the
+        download is complete. A failed download is removed, or with
+        ``resume`` kept together with a sidecar so that the next call only
+        fetches the rest, see dvrip_download.PartialDownload. ``by_time``
+        fetches just ``startTime`` to ``endTime`` of the file. With
+        ``sink`` the data is handed to it instead, see get_file().
+        ``progress(received)`` is called after every packet. Returns the
+        number of bytes received. ByTime requests name the channel instead
+        of the file, so ``channel`` is required with ``resume`` and
+        ``by_time``.
+        """
+        self.check_direct("download_file()")
+        if channel is None and (by_time or (resume and sink is None)):
+            raise ValueError("channel is required to resume or download by time")
+        channel = channel or 0
+        self.logger.debug(f"Downloading: {targetFilePath}")
+
+        target = sink
+        if sink is None:
+            target = PartialDownload(targetFilePath, filename, resume, channel)
+            if target.start is not None:
+                startTime = target.start
+                by_time = True
+        mode = {}
+        if by_time:
+            mode = {"PlayMode": "ByTime", "Channel": channel}
+        stop = dict(mode, Channel=channel)
 
         actionStart = "Start"
+        actionStop = "Stop"
         if download:
             actionStart = f"Download{actionStart}"
-
-        data = self.send_custom(
-            1420,
-            {
-                "Name": "OPPlayBack",
-                "OPPlayBack": {
-                    "Action": actionStart,
-                    "Parameter": {
-                        "PlayMode": "ByName",
-                        "FileName": filename,
-                        "StreamType": 0,
-                        "Value": 0,
-                        "TransMode": "TCP",
-                        # Maybe IntelligentPlayBack is needed in some edge case
-                        # "IntelligentPlayBackEvent": "",
-                        # "IntelligentPlayBackSpeed": 0,
-                    },
-                    "StartTime": startTime,
-                    "EndTime": endTime,
-                },
-            },
-            download=True,
-        )
+            actionStop = f"Download{actionStop}"
 
         try:
-            with open(targetFilePath, "wb") as bin_data:
-                bin_data.write(data)
-        except TypeError:
-            Path(targetFilePath).unlink(missing_ok=True)
+            self.send(1424, self.playback_params(filename, startTime, endTime, "Claim", **mode))
+            received = self.send_custom(
+                1420,
+                self.playback_params(filename, startTime, endTime, actionStart, **mode),
+                download=True,
+                sink=target,
+                progress=progress,
+            )
+            if not isinstance(received, int):
+                raise SomethingIsWrongWithCamera("Download did not start")
+            if sink is None:
+                target.close(complete=True)
+        except:
             self.logger.debug(f"An error occured while downloading {targetFilePath}")
+            if sink is None:
+                target.close(complete=False)
+            # stop the transfer and discard what is still in flight
+            self.send(
+                1420,
+                self.playback_params(filename, startTime, endTime, actionStop, **stop),
+                wait_response=False,
+            )
+            with self.busy:
+                self.drain()
             raise
 
         self.logger.debug(f"File successfully downloaded: {targetFilePath}")
 
-        actionStop = "Stop"
-        if download:
-            actionStop = f"Download{actionStop}"
-
         self.send(
             1420,
-            {
-                "Name": "OPPlayBack",
-                "OPPlayBack": {
-                    "Action": actionStop,
-                    "Parameter": {
-                        "FileName": filename,
-                        "PlayMode": "ByName",
-                        "StreamType": 0,
-                        "TransMode": "TCP",
-                        "Channel": 0,
-                        "Value": 0,
-                        # Maybe IntelligentPlayBack is needed in some edge case
-                        # "IntelligentPlayBackEvent": "",
-                        # "IntelligentPlayBackSpeed": 0,
-                    },
-                    "StartTime": startTime,
-                    "EndTime": endTime,
-                },
-            },
+            self.playback_params(filename, startTime, endTime, actionStop, **stop),
         )
-        return None
+        return received
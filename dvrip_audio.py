@@ -0,0 +1,152 @@
+import sys
+from array import array
+from dvrip_framing import AUDIO, MEDIA_SHORT, MEDIA_TYPE
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# G.711 as used by the cameras: 8 kHz mono, one byte per sample. Decoded
+# audio is signed 16 bit little-endian PCM. Every conversion is a table
+# lookup over the whole buffer, done by NumPy when it is installed and by
+# bytes.translate() (decode) or array/map (encode) otherwise.
+SAMPLE_RATE = 8000
+CODECS = {"alaw": 0x0E, "ulaw": 0x0A}
+ENCODE_TYPES = {"alaw": "G711_ALAW", "ulaw": "G711_ULAW"}
+LAWS = {"g711a": "alaw"}  # Frame.type of monitor audio -> law
+
+
+def alaw_to_linear(code):
+    code ^= 0x55
+    exponent = (code >> 4) & 0x07
+    mantissa = code & 0x0F
+    if exponent:
+        value = ((mantissa << 4) + 0x108) << (exponent - 1)
+    else:
+        value = (mantissa << 4) + 8
+    return value if code & 0x80 else -value
+
+
+def ulaw_to_linear(code):
+    code = ~code & 0xFF
+    value = (((code & 0x0F) << 3) + 0x84) << ((code >> 4) & 0x07)
+    return 0x84 - value if code & 0x80 else value - 0x84
+
+
+def linear_to_alaw(sample):
+    if sample >= 0:
+        mask = 0xD5
+    else:
+        mask = 0x55
+        sample = -sample - 1
+    sample = min(sample, 0x7FFF) >> 3
+    if sample < 0x20:
+        return ((sample >> 1) ^ mask) & 0xFF
+    exponent = sample.bit_length() - 5
+    return (((exponent << 4) | ((sample >> exponent) & 0x0F)) ^ mask) & 0xFF
+
+
+def linear_to_ulaw(sample):
+    sample >>= 2
+    if sample < 0:
+        mask = 0x7F
+        sample = -sample
+    else:
+        mask = 0xFF
+    sample = min(sample, 8159) + 0x21
+    exponent = sample.bit_length() - 6
+    if exponent > 7:
+        return 0x7F ^ mask
+    return (((exponent << 4) | ((sample >> (exponent + 1)) & 0x0F)) ^ mask) & 0xFF
+
+
+def decode_tables(to_linear):
+    values = [to_linear(code) & 0xFFFF for code in range(256)]
+    return bytes(v & 0xFF for v in values), bytes(v >> 8 for v in values)
+
+
+def encode_table(to_law):
+    # indexed by the sample as unsigned 16 bit integer
+    return bytes(to_law(s - 0x10000 if s & 0x8000 else s) for s in range(0x10000))
+
+
+DECODE = {"alaw": decode_tables(alaw_to_linear), "ulaw": decode_tables(ulaw_to_linear)}
+ENCODE = {}
+if numpy is not None:
+    DECODE_NUMPY = {
+        law: numpy.frombuffer(lo, numpy.uint8).astype("<u2")
+        | (numpy.frombuffer(hi, numpy.uint8).astype("<u2") << 8)
+        for law, (lo, hi) in DECODE.items()
+    }
+
+
+def encoder(law):
+    # 64 KiB per law, built on first use
+    table = ENCODE.get(law)
+    if table is None:
+        if law not in CODECS:
+            raise ValueError(f"Unknown G.711 law {law}")
+        table = ENCODE[law] = encode_table(linear_to_alaw if law == "alaw" else linear_to_ulaw)
+        if numpy is not None:
+            ENCODE[law + "_numpy"] = numpy.frombuffer(table, numpy.uint8)
+    return table
+
+
+def decode(data, law="alaw"):
+    """G.711 bytes to 16 bit little-endian PCM bytes."""
+    if law not in CODECS:
+        raise ValueError(f"Unknown G.711 law {law}")
+    if numpy is not None:
+        return DECODE_NUMPY[law][numpy.frombuffer(data, numpy.uint8)].tobytes()
+    lo, hi = DECODE[law]
+    data = bytes(data)
+    pcm = bytearray(2 * len(data))
+    pcm[0::2] = data.translate(lo)
+    pcm[1::2] = data.translate(hi)
+    return bytes(pcm)
+
+
+def encode(pcm, law="alaw"):
+    """16 bit little-endian PCM bytes to G.711 bytes."""
+    table = encoder(law)
+    if numpy is not None:
+        return ENCODE[law + "_numpy"][numpy.frombuffer(pcm, "<u2")].tobytes()
+    samples = array("H", bytes(pcm))
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return bytes(map(table.__getitem__, samples))
+
+
+def pcm_frame(frame):
+    """Frame with G.711 audio replaced by a "pcm" Frame, others unchanged."""
+    law = LAWS.get(frame.type)
+    if law is None:
+        return frame
+    return frame._replace(type="pcm", payload=decode(getattr(frame.payload, "view", frame.payload), law))
+
+
+def talk_packets(data, law="alaw", size=320):
+    """Split G.711 ``data`` into OPTalk payloads of ``size`` samples."""
+    codec = CODECS[law]
+    for pos in range(0, len(data), size):
+        chunk = data[pos : pos + size]
+        # sample rate 2 is 8 kHz
+        yield MEDIA_TYPE.pack(AUDIO) + MEDIA_SHORT.pack(codec, 2, len(chunk)) + chunk
+
+
+if __name__ == "__main__":
+    # decode/encode cost per second of audio: python dvrip_audio.py
+    from timeit import timeit
+
+    codes = bytes(range(256))
+    assert encode(decode(codes)) == codes
+    # 0x7F and 0xFF are both zero in u-law
+    assert encode(decode(codes, "ulaw"), "ulaw") == codes.replace(b"\x7f", b"\xff")
+    data = bytes(range(256)) * (SAMPLE_RATE // 256)
+    pcm = decode(data)
+    encode(pcm)
+    n = 1000
+    backend = "numpy" if numpy is not None else "fallback"
+    print(f"{backend}: decode {timeit(lambda: decode(data), number=n) / n * 1e6:.0f} us, "
+          f"encode {timeit(lambda: encode(pcm), number=n) / n * 1e6:.0f} us per second of audio")
@@ -0,0 +1,183 @@
+import sqlite3
+import threading
+import time
+import logging
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    camera TEXT NOT NULL,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    channel INTEGER NOT NULL,
+    begin TEXT NOT NULL,
+    end TEXT NOT NULL,
+    size INTEGER,
+    state TEXT NOT NULL DEFAULT 'pending',
+    updated REAL NOT NULL,
+    PRIMARY KEY (camera, name)
+);
+CREATE INDEX IF NOT EXISTS files_state ON files (camera, type, state, begin);
+CREATE TABLE IF NOT EXISTS watermarks (
+    camera TEXT NOT NULL,
+    type TEXT NOT NULL,
+    channel INTEGER NOT NULL,
+    low TEXT NOT NULL,
+    high TEXT,
+    PRIMARY KEY (camera, type, channel)
+);
+"""
+
+# states that still need a download
+WANTED = ("pending", "failed")
+
+
+class RecordingCatalog(object):
+    """SQLite index of the recordings stored on cameras.
+
+    sync() runs OPFileQuery only for the time the catalog has not seen yet:
+    everything before the earliest synced start, and everything from the
+    BeginTime of the newest known file on (it may still be recording), or
+    from the end of the last sync while there is no file at all. The
+    rows keep FileName, times, size, channel, type and a download state,
+    so pending() is an indexed query instead of a stat() per file. Times
+    are the "YYYY-MM-DD HH:MM:SS" strings of the camera, which sort like
+    the times they stand for.
+    """
+
+    def __init__(self, path):
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.executescript(SCHEMA)
+
+    def sync(self, cam, camera, filetype, start, end, channel=0):
+        """Add the files of ``cam`` between ``start`` and ``end`` not synced
+        before, returns the new ones as OPFileQuery dicts.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT low, high FROM watermarks WHERE camera = ? AND type = ? AND channel = ?",
+                (camera, filetype, channel),
+            ).fetchone()
+        windows = [(start, end)]
+        if row is not None:
+            windows = []
+            if start < row["low"]:
+                windows.append((start, row["low"]))
+            if row["high"] is None or row["high"] < end:
+                windows.append((max(start, row["high"] or row["low"]), end))
+        files = []
+        for begin, until in windows:
+            files += cam.list_local_files(begin, until, filetype, channel=channel)
+        new = self.add(camera, filetype, files, channel)
+        low = start
+        if row is not None:
+            low = min(low, row["low"])
+        with self.lock:
+            (high,) = self.db.execute(
+                "SELECT max(begin) FROM files WHERE camera = ? AND type = ? AND channel = ?",
+                (camera, filetype, channel),
+            ).fetchone()
+        if high is None:
+            # nothing recorded yet, the next sync starts where this one ended
+            high = max(end, row["high"] or "") if row is not None else end
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO watermarks (camera, type, channel, low, high) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (camera, filetype, channel, low, high),
+            )
+        self.logger.debug(
+            "Synced %s %s: %d windows, %d files, %d new", camera, filetype, len(windows), len(files), len(new)
+        )
+        return new
+
+    def add(self, camera, filetype, files, channel=0):
+        """Insert ``files``, or update the end time and size of known ones."""
+        new = []
+        now = time.time()
+        with self.lock, self.db:
+            for file in files:
+                size = file.get("FileLength")
+                if isinstance(size, str):
+                    size = int(size, 16)
+                cursor = self.db.execute(
+                    "INSERT OR IGNORE INTO files "
+                    "(camera, name, type, channel, begin, end, size, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (camera, file["FileName"], filetype, channel, file["BeginTime"], file["EndTime"], size, now),
+                )
+                if cursor.rowcount:
+                    new.append(file)
+                else:
+                    self.db.execute(
+                        "UPDATE files SET end = ?, size = ?, updated = ? "
+                        "WHERE camera = ? AND name = ? AND (end != ? OR size IS NOT ?)",
+                        (file["EndTime"], size, now, camera, file["FileName"], file["EndTime"], size),
+                    )
+        return new
+
+    def files(self, camera, filetype=None, start=None, end=None, states=None, limit=None):
+        """OPFileQuery style dicts plus "State", newest first."""
+        query = "SELECT * FROM files WHERE camera = ?"
+        args = [camera]
+        if filetype is not None:
+            query += " AND type = ?"
+            args.append(filetype)
+        if states is not None:
+            query += " AND state IN (%s)" % ",".join("?" * len(states))
+            args += states
+        if start is not None:
+            query += " AND begin >= ?"
+            args.append(start)
+        if end is not None:
+            query += " AND begin <= ?"
+            args.append(end)
+        query += " ORDER BY begin DESC"
+        if limit is not None:
+            query += " LIMIT %d" % limit
+        with self.lock:
+            rows = self.db.execute(query, args).fetchall()
+        return [
+            {
+                "FileName": row["name"],
+                "BeginTime": row["begin"],
+                "EndTime": row["end"],
+                "FileLength": row["size"],
+                "Channel": row["channel"],
+                "Type": row["type"],
+                "State": row["state"],
+            }
+            for row in rows
+        ]
+
+    def pending(self, camera, filetype=None, start=None, end=None, limit=None):
+        """Files still to download (new or failed before), newest first."""
+        return self.files(camera, filetype, start, end, WANTED, limit)
+
+    def mark(self, camera, names, state):
+        """Set the download state, e.g. "done", "failed" or "skipped"."""
+        if isinstance(names, str):
+            names = [names]
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                "UPDATE files SET state = ?, updated = ? WHERE camera = ? AND name = ?",
+                [(state, now, camera, name) for name in names],
+            )
+
+    def stats(self, camera=None):
+        """Number of files per state."""
+        query = "SELECT state, count(*) FROM files"
+        args = []
+        if camera is not None:
+            query += " WHERE camera = ?"
+            args.append(camera)
+        with self.lock:
+            return dict(self.db.execute(query + " GROUP BY state", args).fetchall())
+
+    def close(self):
+        with self.lock:
+            self.db.close()
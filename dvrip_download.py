@@ -0,0 +1,126 @@
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+from dvrip_framing import IFRAME, MEDIA_TYPE, MEDIA_VIDEO, internal_to_datetime
+
+# recordings keep the media sub-headers of the live stream, so every I-frame
+# starts with 00 00 01 FC and its camera time; H.264/H.265 never contain
+# this byte sequence (0xFC is not a valid NAL header)
+IFRAME_MARK = MEDIA_TYPE.pack(IFRAME)
+IFRAME_HEADER = MEDIA_TYPE.size + MEDIA_VIDEO.size
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class PartialDownload(object):
+    """download_file() sink writing ``path.part`` and renaming it when done.
+
+    While writing it notes the offset of the first I-frame of every camera
+    second. With ``resume`` the last such point is saved to the
+    ``path.part.json`` sidecar, and a failed download keeps both files: the
+    next PartialDownload of the same recording cuts the part file back to
+    that I-frame, ``start`` is the time to request ByTime from, and data
+    before the first I-frame of that second is skipped. The sidecar also
+    keeps the ``channel``, a sidecar of another channel is ignored. Without
+    ``resume`` a failed download is removed.
+    """
+
+    def __init__(self, path, filename, resume=False, channel=0, save_every=1 << 20):
+        self.logger = logging.getLogger(__name__)
+        self.path = Path(path)
+        self.part = Path(f"{path}.part")
+        self.sidecar = Path(f"{path}.part.json")
+        self.filename = filename
+        self.channel = channel
+        self.resume = resume
+        self.save_every = save_every
+        self.keyframe = None  # (offset, datetime) to resume from
+        self.skip_until = None
+        self.start = None
+        state = self.load() if resume else None
+        if state is not None:
+            self.keyframe = (state["offset"], datetime.strptime(state["time"], TIME_FORMAT))
+            self.skip_until = self.keyframe[1]
+            self.start = state["time"]
+            self.logger.debug("Resuming %s at %s (%d bytes)", path, self.start, state["offset"])
+        self.offset = self.keyframe[0] if self.keyframe else 0
+        self.saved = self.offset
+        self.part.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.part, "r+b" if self.offset else "wb", buffering=1 << 20)
+        self.file.truncate(self.offset)
+        self.file.seek(self.offset)
+        self.tail = b""
+
+    def load(self):
+        try:
+            with open(self.sidecar) as f:
+                state = json.load(f)
+            if (
+                state["FileName"] == self.filename
+                and state.get("Channel") == self.channel
+                and self.part.stat().st_size >= state["offset"]
+            ):
+                return state
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def save(self):
+        if self.keyframe is None:
+            return
+        self.file.flush()
+        state = {
+            "FileName": self.filename,
+            "Channel": self.channel,
+            "offset": self.keyframe[0],
+            "time": self.keyframe[1].strftime(TIME_FORMAT),
+            "received": self.offset,
+        }
+        with open(self.sidecar, "w") as f:
+            json.dump(state, f)
+        self.saved = self.offset
+
+    def write(self, data):
+        window = self.tail + bytes(data)
+        if self.skip_until is not None:
+            pos = self.find(window, 0)
+            while pos is not None and self.time(window, pos) < self.skip_until:
+                pos = self.find(window, pos + 1)
+            if pos is None:
+                self.tail = window[-(IFRAME_HEADER - 1) :]
+                return
+            self.skip_until = None
+            window = window[pos:]
+            start = 0
+        else:
+            start = len(self.tail)
+        self.file.write(memoryview(window)[start:])
+        base = self.offset - start
+        pos = self.find(window, 0)
+        while pos is not None:
+            when = self.time(window, pos)
+            if self.keyframe is None or when != self.keyframe[1]:
+                self.keyframe = (base + pos, when)
+            pos = self.find(window, pos + 1)
+        self.offset = base + len(window)
+        self.tail = window[-(IFRAME_HEADER - 1) :]
+        if self.resume and self.offset - self.saved >= self.save_every:
+            self.save()
+
+    def find(self, window, pos):
+        # only complete sub-headers, a split one is found in the next window
+        pos = window.find(IFRAME_MARK, pos, len(window) - IFRAME_HEADER + len(IFRAME_MARK))
+        return None if pos == -1 else pos
+
+    def time(self, window, pos):
+        return internal_to_datetime(MEDIA_VIDEO.unpack_from(window, pos + MEDIA_TYPE.size)[4])
+
+    def close(self, complete):
+        if not complete and self.resume:
+            self.save()
+        self.file.close()
+        if complete:
+            self.part.replace(self.path)
+            self.sidecar.unlink(missing_ok=True)
+        elif not self.resume:
+            self.part.unlink(missing_ok=True)
@@ -0,0 +1,190 @@
+import struct
+from collections import namedtuple
+from datetime import datetime
+
+# Every DVRIP packet starts with the same 20 byte little-endian header:
+#   head(0xFF) version reserved session sequence total cur msgid length
+# "total"/"cur" are the fragment counters of media packets, the upgrade
+# trailer sets cur=1, and the UDP search/config packets use "reserved".
+HEADER = struct.Struct("<BBHIIBBHI")
+HEADER_SIZE = HEADER.size
+HEAD = 255
+
+Header = namedtuple(
+    "Header",
+    ["head", "version", "reserved", "session", "sequence", "total", "cur", "msgid", "length"],
+)
+
+# one media frame as yielded by iter_frames(); kind is "I"/"P" for video
+# and None otherwise, P-frames carry the fps/size/timestamp of their I-frame
+Frame = namedtuple(
+    "Frame",
+    ["type", "kind", "fps", "width", "height", "timestamp", "payload", "channel", "stream"],
+)
+
+# media sub-headers at the start of the first packet of a frame
+MEDIA_TYPE = struct.Struct(">I")
+MEDIA_VIDEO = struct.Struct("<BBBBII")  # media, fps, width/8, height/8, datetime, length
+MEDIA_PFRAME = struct.Struct("<I")  # length
+MEDIA_SHORT = struct.Struct("<BBH")  # media, sample rate/count, length
+
+IFRAME = 0x1FC
+PFRAME = 0x1FD
+SNAPSHOT = 0x1FE
+AUDIO = 0x1FA
+INFO = 0x1F9
+JPEG = 0xFFD8FFE0
+
+TAIL = b"\x0a\x00"
+
+
+def pack_header(msgid, length, session=0, sequence=0, version=0, total=0, cur=0, reserved=0):
+    return HEADER.pack(HEAD, version, reserved, session, sequence, total, cur, msgid, length)
+
+
+def pack_header_into(
+    buf, offset, msgid, length, session=0, sequence=0, version=0, total=0, cur=0, reserved=0
+):
+    HEADER.pack_into(
+        buf, offset, HEAD, version, reserved, session, sequence, total, cur, msgid, length
+    )
+
+
+_new_header = tuple.__new__
+_unpack_header = HEADER.unpack_from
+
+
+def unpack_header(data, offset=0):
+    return _new_header(Header, _unpack_header(data, offset))
+
+
+def build_packet(
+    msgid, payload=b"", session=0, sequence=0, version=0, tail=TAIL, total=0, cur=0, reserved=0
+):
+    """Header, payload and tail joined with a single copy of the payload."""
+    header = HEADER.pack(
+        HEAD,
+        version,
+        reserved,
+        session,
+        sequence,
+        total,
+        cur,
+        msgid,
+        len(payload) + len(tail),
+    )
+    return b"".join((header, payload, tail))
+
+
+def media_header_size(data_type):
+    if data_type == IFRAME or data_type == SNAPSHOT:
+        return 16
+    return 8
+
+
+def internal_to_type(data_type, value):
+    if data_type == IFRAME or data_type == PFRAME:
+        if value == 1:
+            return "mpeg4"
+        elif value == 2:
+            return "h264"
+        elif value == 3:
+            return "h265"
+    elif data_type == INFO:
+        if value == 1 or value == 6:
+            return "info"
+    elif data_type == AUDIO:
+        if value == 0xE:
+            return "g711a"
+    elif data_type == SNAPSHOT and value == 0:
+        return "jpeg"
+    return None
+
+
+def internal_to_datetime(value):
+    second = value & 0x3F
+    minute = (value & 0xFC0) >> 6
+    hour = (value & 0x1F000) >> 12
+    day = (value & 0x3E0000) >> 17
+    month = (value & 0x3C00000) >> 22
+    year = ((value & 0xFC000000) >> 26) + 2000
+    return datetime(year, month, day, hour, minute, second)
+
+
+def datetime_to_internal(value):
+    return (
+        ((value.year - 2000) << 26)
+        | (value.month << 22)
+        | (value.day << 17)
+        | (value.hour << 12)
+        | (value.minute << 6)
+        | value.second
+    )
+
+
+def parse_media_header(data_type, packet, metadata):
+    """Fill metadata from a media sub-header, return the announced length."""
+    media = None
+    if data_type == IFRAME or data_type == SNAPSHOT:
+        (media, metadata["fps"], w, h, dt, length) = MEDIA_VIDEO.unpack_from(packet, 4)
+        metadata["width"] = w * 8
+        metadata["height"] = h * 8
+        metadata["datetime"] = internal_to_datetime(dt)
+        if data_type == IFRAME:
+            metadata["frame"] = "I"
+    elif data_type == PFRAME:
+        (length,) = MEDIA_PFRAME.unpack_from(packet, 4)
+        metadata["frame"] = "P"
+    elif data_type == AUDIO:
+        (media, samp_rate, length) = MEDIA_SHORT.unpack_from(packet, 4)
+    elif data_type == INFO:
+        (media, n, length) = MEDIA_SHORT.unpack_from(packet, 4)
+    else:
+        raise ValueError(data_type)
+    if media is not None:
+        metadata["type"] = internal_to_type(data_type, media)
+    return length
+
+
+def make_frame(payload, metadata, video, channel=None, stream=None):
+    """Frame record from parse_media_header() metadata.
+
+    ``video`` is a dict owned by the caller that keeps the fields of the
+    last I-frame for the P-frames following it.
+    """
+    kind = metadata.get("frame")
+    if kind is None:
+        return Frame(
+            metadata.get("type"), None, None, None, None, None, payload, channel, stream
+        )
+    if kind == "I":
+        video.update(metadata)
+    return Frame(
+        video.get("type"),
+        kind,
+        video.get("fps"),
+        video.get("width"),
+        video.get("height"),
+        video.get("datetime"),
+        payload,
+        channel,
+        stream,
+    )
+
+
+if __name__ == "__main__":
+    # microbenchmark of header encode/decode: python dvrip_framing.py
+    from timeit import timeit
+
+    n = 1000000
+    buf = bytearray(HEADER_SIZE)
+    raw = pack_header(1042, 128, 0x1234, 7)
+    cases = [
+        ("pack_header", lambda: pack_header(1042, 128, 0x1234, 7)),
+        ("pack_header_into", lambda: pack_header_into(buf, 0, 1042, 128, 0x1234, 7)),
+        ("HEADER.unpack_from", lambda: HEADER.unpack_from(raw)),
+        ("unpack_header", lambda: unpack_header(raw)),
+        ("build_packet", lambda: build_packet(1042, b"x" * 64, 0x1234, 7)),
+    ]
+    for name, func in cases:
+        print(f"{name:20s} {timeit(func, number=n) / n * 1e9:8.1f} ns")
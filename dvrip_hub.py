@@ -0,0 +1,206 @@
+import threading
+import logging
+from dvrip import DVRIPCam, BufferArena, SomethingIsWrongWithCamera
+from dvrip_queue import FrameQueue
+
+
+class Subscription(object):
+    """One consumer of a hub stream, iterate it for Frame records.
+
+    Frames are delivered through a FrameQueue of its own, so a slow
+    subscriber only drops its own frames. A subscriber joining a running
+    stream starts at the next I-frame. The payload is an ArenaBuffer shared
+    with the other subscribers; it stays valid until the next frame is
+    taken, retain() it to keep it longer.
+    """
+
+    def __init__(self, hub, upstream, queue):
+        self.hub = hub
+        self.upstream = upstream
+        self.queue = queue
+        self.synced = False
+
+    def __iter__(self):
+        frame = None
+        try:
+            for frame in self.queue:
+                yield frame
+                frame.payload.release()
+                frame = None
+        finally:
+            if frame is not None:
+                frame.payload.release()
+        if self.upstream.error is not None:
+            raise self.upstream.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def deliver(self, frame):
+        if not self.synced:
+            if frame.kind == "P":
+                return
+            self.synced = frame.kind == "I"
+        frame.payload.retain()
+        if not self.queue.put(frame, frame.kind):
+            frame.payload.release()
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+    def stats(self):
+        return self.queue.stats()
+
+
+class Upstream(object):
+    """The single monitor session of a (camera, channel, stream)."""
+
+    def __init__(self, hub, key, credentials):
+        self.hub = hub
+        self.key = key
+        self.credentials = credentials
+        self.cam = None
+        self.error = None
+        self.subscribers = []
+        self.stopped = False
+        self.thread = threading.Thread(
+            name="DVRHub%s:%d/%d/%s" % (key[0], key[1], key[3], key[4]),
+            target=self.run,
+        )
+        self.thread.daemon = True
+
+    def open(self):
+        ip, port, user, channel, stream = self.key
+        password, hash_pass = self.credentials
+        if self.hub.pool is not None:
+            return self.hub.pool.checkout(ip, port, user, password, hash_pass)
+        kwargs = dict(self.hub.cam_kwargs)
+        if hash_pass is not None:
+            kwargs["hash_pass"] = hash_pass
+        elif password is not None:
+            kwargs["password"] = password
+        cam = DVRIPCam(ip, port=port, user=user, **kwargs)
+        if not cam.login():
+            cam.close()
+            raise SomethingIsWrongWithCamera(f"Cannot login to {ip}")
+        return cam
+
+    def run(self):
+        ip, port, user, channel, stream = self.key
+        discard = False
+        try:
+            self.cam = self.open()
+            if self.stopped:
+                return
+            for frame in self.cam.iter_frames(channel, stream, arena=self.hub.arena):
+                with self.hub.lock:
+                    subscribers = list(self.subscribers)
+                for subscriber in subscribers:
+                    subscriber.deliver(frame)
+                if self.stopped:
+                    break
+        except Exception as e:
+            self.hub.logger.debug("Stream %s failed: %s", self.key, e)
+            self.error = e
+            discard = True
+        finally:
+            self.hub.finished(self)
+            if self.cam is not None:
+                if self.hub.pool is not None:
+                    self.hub.pool.checkin(self.cam, discard=discard)
+                else:
+                    self.cam.close()
+
+    def stop(self):
+        self.stopped = True
+        if self.cam is not None:
+            self.cam.stop_monitor()
+
+
+class StreamHub(object):
+    """Share one monitor session per (camera, channel, stream) in-process.
+
+    subscribe() returns a Subscription. The first subscriber of a stream
+    starts the upstream session on its own thread, the last one to close()
+    stops it. Sessions come from ``pool`` (a dvrip_pool.SessionPool) when
+    given, otherwise they are opened with ``cam_kwargs``. All streams
+    receive into the shared ``arena``, so fan-out does not copy frames.
+    """
+
+    def __init__(self, pool=None, arena=None, maxsize=64, policy="drop_p", **cam_kwargs):
+        self.logger = logging.getLogger(__name__)
+        self.pool = pool
+        self.arena = arena or BufferArena()
+        self.maxsize = maxsize
+        self.policy = policy
+        self.cam_kwargs = cam_kwargs
+        self.lock = threading.Lock()
+        self.upstreams = {}
+
+    def subscribe(
+        self,
+        ip,
+        port=None,
+        user="admin",
+        password=None,
+        hash_pass=None,
+        channel=0,
+        stream="Main",
+        maxsize=None,
+        policy=None,
+    ):
+        key = (ip, port or DVRIPCam.PORTS["tcp"], user, channel, stream)
+        queue = FrameQueue(
+            maxsize or self.maxsize,
+            policy or self.policy,
+            discard=lambda frame: frame.payload.release(),
+        )
+        with self.lock:
+            upstream = self.upstreams.get(key)
+            start = upstream is None
+            if start:
+                upstream = self.upstreams[key] = Upstream(
+                    self, key, (password, hash_pass)
+                )
+            subscription = Subscription(self, upstream, queue)
+            upstream.subscribers.append(subscription)
+        if start:
+            upstream.thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        upstream = subscription.upstream
+        with self.lock:
+            if subscription not in upstream.subscribers:
+                return
+            upstream.subscribers.remove(subscription)
+            stop = not upstream.subscribers
+            if stop and self.upstreams.get(upstream.key) is upstream:
+                # a new subscriber gets a fresh upstream from now on
+                del self.upstreams[upstream.key]
+        subscription.queue.close(discard=True)
+        if stop:
+            upstream.stop()
+
+    def finished(self, upstream):
+        with self.lock:
+            if self.upstreams.get(upstream.key) is upstream:
+                del self.upstreams[upstream.key]
+            subscribers = list(upstream.subscribers)
+        for subscription in subscribers:
+            subscription.queue.close()
+
+    def streams(self):
+        """Subscriber count of every running upstream."""
+        with self.lock:
+            return {key: len(u.subscribers) for key, u in self.upstreams.items()}
+
+    def close(self):
+        with self.lock:
+            upstreams = list(self.upstreams.values())
+        for upstream in upstreams:
+            for subscription in list(upstream.subscribers):
+                subscription.close()
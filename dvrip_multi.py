@@ -0,0 +1,130 @@
+import threading
+import logging
+from dvrip import DVRIPCam, ReconnectPolicy, SomethingIsWrongWithCamera
+from dvrip_framing import make_frame
+from dvrip_reactor import Reactor
+
+
+class MultiMonitor(object):
+    """Monitor many channels and streams of one device from one reader loop.
+
+    ``cam`` is logged in once. Every add(channel, stream) opens a media
+    socket that is claimed with the session id of that login, and all media
+    sockets plus the control session are driven by one Reactor, so an NVR
+    costs a single thread however many channels are recorded.
+    ``on_frame(frame)`` gets Frame records tagged with channel and stream;
+    it runs on the reactor thread and must hand slow work off, e.g. to a
+    dvrip_queue.FrameQueue per stream. A media socket that goes silent is
+    claimed again following ``cam.reconnect_policy``.
+    """
+
+    def __init__(self, cam, on_frame, reactor=None):
+        self.logger = logging.getLogger(__name__)
+        self.cam = cam
+        self.on_frame = on_frame
+        self.own_reactor = reactor is None
+        self.reactor = reactor or Reactor()
+        self.lock = threading.Lock()
+        self.streams = {}  # (channel, stream) -> media DVRIPCam
+        self.video = {}  # (channel, stream) -> last I-frame metadata
+        self.running = False
+
+    def start(self):
+        if self.cam.socket is None and not self.cam.login():
+            raise SomethingIsWrongWithCamera(f"Cannot login to {self.cam.ip}")
+        self.running = True
+        # the control session stays attached for keep-alives and requests
+        self.reactor.add(self.cam, on_dead=self.control_dead)
+        if self.own_reactor:
+            self.reactor.start()
+
+    def open(self, channel, stream):
+        cam = self.cam
+        media = DVRIPCam(cam.ip, port=cam.port, user=cam.user, hash_pass=cam.hash_pass)
+        media.connect(cam.timeout)
+        media.session = cam.session
+        media.alive_time = cam.alive_time
+        params = cam.monitor_params(channel, stream)
+        data = media.set_command("OPMonitor", {"Action": "Claim", "Parameter": params})
+        if data is None or data["Ret"] not in media.OK_CODES:
+            media.close()
+            raise SomethingIsWrongWithCamera(
+                f"Cannot claim channel {channel} {stream} of {cam.ip}"
+            )
+        media.monitor_command("Start", params)
+        return media
+
+    def add(self, channel=0, stream="Main"):
+        key = (channel, stream)
+        media = self.open(channel, stream)
+        with self.lock:
+            old = self.streams.get(key)
+            self.streams[key] = media
+            self.video[key] = {}
+        if old is not None:
+            old.close()
+        self.reactor.add(
+            media,
+            on_frame=lambda m, frame, meta: self.deliver(key, frame, meta),
+            on_dead=lambda m: self.media_dead(key, m),
+            keepalive=False,
+        )
+        return key
+
+    def add_all(self, channels, streams=("Main",)):
+        for channel in channels:
+            for stream in streams:
+                self.add(channel, stream)
+
+    def remove(self, channel=0, stream="Main"):
+        with self.lock:
+            media = self.streams.pop((channel, stream), None)
+        if media is not None:
+            # the device stops streaming once the media socket is closed
+            media.close()
+
+    def deliver(self, key, frame, meta):
+        video = self.video.get(key)
+        if video is not None:
+            self.on_frame(make_frame(frame, meta, video, key[0], key[1]))
+
+    def media_dead(self, key, media):
+        with self.lock:
+            if not self.running or self.streams.get(key) is not media:
+                return
+        thread = threading.Thread(
+            name="DVRMultiRestart%s/%d/%s" % (self.cam.ip, key[0], key[1]),
+            target=self.restart,
+            args=[key, media],
+        )
+        thread.daemon = True
+        thread.start()
+
+    def restart(self, key, media):
+        policy = self.cam.reconnect_policy or ReconnectPolicy(max_attempts=3)
+        for delay in policy.delays():
+            if self.cam.stopped.wait(delay):
+                return
+            with self.lock:
+                if not self.running or self.streams.get(key) is not media:
+                    return
+            try:
+                self.add(*key)
+                return
+            except SomethingIsWrongWithCamera as e:
+                self.logger.debug("Cannot restart %s of %s: %s", key, self.cam.ip, e)
+        self.logger.warning("Gave up on channel %d %s of %s", key[0], key[1], self.cam.ip)
+
+    def control_dead(self, cam):
+        self.logger.warning("Control session to %s is dead", cam.ip)
+        self.stop()
+
+    def stop(self):
+        self.running = False
+        with self.lock:
+            streams, self.streams = self.streams, {}
+        for media in streams.values():
+            media.close()
+        self.reactor.remove(self.cam)
+        if self.own_reactor:
+            self.reactor.stop()
@@ -0,0 +1,270 @@
+import threading
+import time
+import logging
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dvrip import DVRIPCam, SomethingIsWrongWithCamera
+from dvrip_codec import templates
+
+SnapshotResult = namedtuple("SnapshotResult", ["target", "jpeg", "error", "elapsed"])
+
+
+class SessionPool(object):
+    """Logged-in DVRIPCam sessions shared between callers.
+
+    Sessions are keyed by (ip, port, user). checkout() hands out an idle
+    session if one is healthy, otherwise logs in a new one as long as the
+    camera is below ``max_per_camera``, otherwise waits for a checkin().
+    Idle sessions older than ``ttl`` seconds are closed, by checkout() and
+    by a reaper thread every ``ttl / 2`` seconds until close(), and
+    sessions idle for longer than ``check_after`` seconds get a KeepAlive
+    round-trip before being handed out again.
+    """
+
+    def __init__(self, ttl=300, max_per_camera=2, check_after=5, timeout=30, **cam_kwargs):
+        self.logger = logging.getLogger(__name__)
+        self.ttl = ttl
+        self.max_per_camera = max_per_camera
+        self.check_after = check_after
+        self.timeout = timeout
+        self.cam_kwargs = cam_kwargs
+        self.lock = threading.Condition()
+        self.idle = {}  # key -> [(cam, last_used), ...]
+        self.count = {}  # key -> sessions opened, idle or checked out
+        self.credentials = {}  # key -> password/hash_pass for new sessions
+        self.keys = {}  # id(cam) -> key of checked out sessions
+        self.closed = threading.Event()
+        self.reaper = threading.Thread(name="DVRPoolReaper", target=self.reap)
+        self.reaper.daemon = True
+        self.reaper.start()
+
+    def key(self, ip, port=None, user="admin"):
+        return (ip, port or DVRIPCam.PORTS["tcp"], user)
+
+    def checkout(self, ip, port=None, user="admin", password=None, hash_pass=None):
+        key = self.key(ip, port, user)
+        deadline = time.time() + self.timeout
+        with self.lock:
+            if password is not None or hash_pass is not None:
+                self.credentials[key] = (password, hash_pass)
+            while True:
+                self.evict_idle(key)
+                idle = self.idle.get(key)
+                if idle:
+                    cam, last_used = idle.pop()
+                    break
+                if self.count.get(key, 0) < self.max_per_camera:
+                    self.count[key] = self.count.get(key, 0) + 1
+                    cam = None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise SomethingIsWrongWithCamera(
+                        f"No free session for {ip} within {self.timeout}s"
+                    )
+                self.lock.wait(remaining)
+
+        if cam is not None and not self.healthy(cam, last_used):
+            self.discard(cam, key)
+            return self.checkout(ip, port, user)
+        if cam is None:
+            try:
+                cam = self.open(key)
+            except:
+                with self.lock:
+                    self.count[key] -= 1
+                    self.lock.notify()
+                raise
+        with self.lock:
+            self.keys[id(cam)] = key
+        return cam
+
+    def checkin(self, cam, discard=False):
+        with self.lock:
+            key = self.keys.pop(id(cam), None)
+            if key is None:
+                return
+            if discard:
+                cam.close()
+            if cam.socket is None:
+                self.count[key] -= 1
+            else:
+                self.idle.setdefault(key, []).append((cam, time.time()))
+            self.lock.notify()
+
+    @contextmanager
+    def session(self, ip, port=None, user="admin", password=None, hash_pass=None):
+        cam = self.checkout(ip, port, user, password, hash_pass)
+        try:
+            yield cam
+        except (OSError, SomethingIsWrongWithCamera):
+            # do not hand a half-broken connection to the next caller
+            with self.lock:
+                key = self.keys.pop(id(cam), None)
+            if key is not None:
+                self.discard(cam, key)
+            raise
+        finally:
+            self.checkin(cam)
+
+    def open(self, key):
+        ip, port, user = key
+        password, hash_pass = self.credentials.get(key, (None, None))
+        kwargs = dict(self.cam_kwargs)
+        if hash_pass is not None:
+            kwargs["hash_pass"] = hash_pass
+        elif password is not None:
+            kwargs["password"] = password
+        cam = DVRIPCam(ip, port=port, user=user, **kwargs)
+        if not cam.login():
+            cam.close()
+            raise SomethingIsWrongWithCamera(f"Cannot login to {ip}")
+        self.logger.debug("Opened session %08X to %s:%d", cam.session, ip, port)
+        return cam
+
+    def healthy(self, cam, last_used):
+        if cam.socket is None:
+            return False
+        if time.time() - last_used < self.check_after:
+            return True
+        reply = cam.send(
+            cam.QCODES["KeepAlive"],
+            templates.command("KeepAlive").render(cam.session),
+        )
+        return reply is not None and reply.get("Ret") in cam.OK_CODES
+
+    def discard(self, cam, key):
+        cam.close()
+        with self.lock:
+            self.count[key] -= 1
+            self.lock.notify()
+
+    def evict_idle(self, key=None):
+        now = time.time()
+        expired = []
+        with self.lock:
+            for k in [key] if key is not None else list(self.idle):
+                keep = []
+                for cam, last_used in self.idle.get(k, []):
+                    if now - last_used > self.ttl or cam.socket is None:
+                        expired.append(cam)
+                        self.count[k] -= 1
+                    else:
+                        keep.append((cam, last_used))
+                self.idle[k] = keep
+            if expired:
+                self.lock.notify_all()
+        for cam in expired:
+            cam.close()
+        return len(expired)
+
+    def reap(self):
+        # cameras that are never checked out again are only evicted here
+        while not self.closed.wait(max(self.ttl / 2, 1)):
+            self.evict_idle()
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            idle, self.idle = self.idle, {}
+            for k, sessions in idle.items():
+                self.count[k] -= len(sessions)
+        for sessions in idle.values():
+            for cam, last_used in sessions:
+                cam.close()
+
+
+def fleet_snapshots(targets, pool=None, workers=32, deadline=5.0):
+    """Fetch one snapshot from each of many cameras concurrently.
+
+    ``targets`` are IP addresses or dicts of checkout() arguments plus an
+    optional "channel". At most ``workers`` snapshots run at a time, each
+    with ``deadline`` seconds from when it starts, sessions included.
+    Yields a SnapshotResult per target as soon as it is known, in
+    completion order: ``jpeg`` is None and ``error`` the exception when the
+    camera failed or ran out of time. The session of a camera over its
+    deadline is disconnected so the worker is freed at once. Pass a
+    long-lived ``pool`` to keep the sessions logged in between calls.
+    """
+    targets = list(targets)
+    own = pool is None
+    if own:
+        pool = SessionPool(max_per_camera=1)
+    lock = threading.Lock()
+    running = {}  # index -> [start, cam] of snapshots in progress
+    started = {}
+    workers_left = [0]  # fetch() calls in progress
+    finished = [False]  # the generator is done, the last worker closes the pool
+
+    def fetch(i, target):
+        with lock:
+            started[i] = running[i] = [time.monotonic(), None]
+            workers_left[0] += 1
+        try:
+            args = dict(target) if isinstance(target, dict) else {"ip": target}
+            channel = args.pop("channel", 0)
+            cam = pool.checkout(**args)
+            jpeg = None
+            try:
+                with lock:
+                    if i not in running:
+                        raise SomethingIsWrongWithCamera("Deadline exceeded")
+                    running[i][1] = cam
+                jpeg = cam.snapshot(channel)
+            finally:
+                # a disconnected or half-read session must not be reused
+                pool.checkin(cam, discard=jpeg is None)
+        finally:
+            with lock:
+                running.pop(i, None)
+                workers_left[0] -= 1
+                last = finished[0] and not workers_left[0]
+            if last and own:
+                pool.close()
+        if jpeg is None:
+            raise SomethingIsWrongWithCamera("No snapshot received")
+        return jpeg
+
+    executor = ThreadPoolExecutor(workers, thread_name_prefix="DVRSnapshot")
+    try:
+        futures = {executor.submit(fetch, i, t): i for i, t in enumerate(targets)}
+        pending = {i: f for f, i in futures.items()}
+        while pending:
+            now = time.monotonic()
+            with lock:
+                expired = [
+                    (i, cam) for i, (start, cam) in running.items() if now - start >= deadline
+                ]
+                for i, _ in expired:
+                    del running[i]
+                starts = [start for start, _ in running.values()]
+            for i, cam in expired:
+                if cam is not None:
+                    cam.disconnect()
+                del pending[i]
+                error = SomethingIsWrongWithCamera(f"No snapshot within {deadline}s")
+                yield SnapshotResult(targets[i], None, error, deadline)
+            if not pending:
+                break
+            timeout = min(starts) + deadline - now if starts else deadline
+            done, _ = wait(list(pending.values()), max(timeout, 0.01), FIRST_COMPLETED)
+            for future in done:
+                i = futures[future]
+                if pending.pop(i, None) is None:
+                    continue
+                error = future.exception()
+                jpeg = None if error is not None else future.result()
+                elapsed = time.monotonic() - started[i][0]
+                yield SnapshotResult(targets[i], jpeg, error, elapsed)
+    finally:
+        for future in futures:
+            future.cancel()
+        # workers still logging in to a dead camera finish on their own,
+        # the last of them closes an own pool
+        executor.shutdown(wait=False)
+        with lock:
+            finished[0] = True
+            last = not workers_left[0]
+        if last and own:
+            pool.close()
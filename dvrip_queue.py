@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import deque
+from queue import Empty
+
+
+class FrameQueue(object):
+    """Bounded queue between a stream reader thread and a slow consumer.
+
+    ``policy`` decides what happens to a new frame when the queue is full:
+    "block" waits for the consumer (the camera then sees TCP backpressure),
+    "drop_oldest" drops the oldest queued frame, and "drop_p" drops P-frames
+    and audio until the next I-frame, which in turn evicts the oldest GOP,
+    so the consumer always gets a decodable stream. ``discard(item)`` is
+    called for every item dropped, e.g. to release arena buffers.
+    """
+
+    POLICIES = ("block", "drop_oldest", "drop_p")
+
+    def __init__(self, maxsize=64, policy="drop_p", discard=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown queue policy {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.discard = discard
+        self.items = deque()  # (kind, item)
+        self.lock = threading.Condition()
+        self.closed = False
+        self.skipping = False
+        self.dropped = {"oldest": 0, "until_iframe": 0, "gop": 0}
+        self.queued = 0
+        self.high_water = 0
+        self.blocked = 0.0
+
+    def __len__(self):
+        return len(self.items)
+
+    def drop(self, item, reason):
+        self.dropped[reason] += 1
+        if self.discard is not None:
+            self.discard(item)
+
+    def put(self, item, kind=None):
+        """Queue ``item``, ``kind`` is "I" or "P" for video frames.
+
+        Returns False once the queue is closed, the item is not queued then.
+        """
+        with self.lock:
+            if self.closed:
+                return False
+            if self.policy == "drop_p":
+                if kind == "I":
+                    self.skipping = False
+                elif kind == "P" and self.skipping:
+                    self.drop(item, "until_iframe")
+                    return True
+            while len(self.items) >= self.maxsize:
+                if self.policy == "block":
+                    start = time.time()
+                    self.lock.wait()
+                    self.blocked += time.time() - start
+                    if self.closed:
+                        return False
+                elif self.policy == "drop_oldest":
+                    self.drop(self.items.popleft()[1], "oldest")
+                elif kind != "I":
+                    # the frames up to the next I-frame cannot be decoded
+                    self.skipping = self.skipping or kind == "P"
+                    self.drop(item, "until_iframe")
+                    return True
+                else:
+                    self.drop(self.items.popleft()[1], "gop")
+                    while self.items and self.items[0][0] != "I":
+                        self.drop(self.items.popleft()[1], "gop")
+            self.items.append((kind, item))
+            self.queued += 1
+            self.high_water = max(self.high_water, len(self.items))
+            self.lock.notify_all()
+        return True
+
+    def get(self, timeout=None):
+        """Oldest item, or None once the queue is closed and empty.
+
+        Raises queue.Empty if nothing arrives within ``timeout`` seconds.
+        """
+        with self.lock:
+            if not self.lock.wait_for(lambda: self.items or self.closed, timeout):
+                raise Empty
+            if not self.items:
+                return None
+            kind, item = self.items.popleft()
+            self.lock.notify_all()
+        return item
+
+    def __iter__(self):
+        while True:
+            item = self.get()
+            if item is None:
+                return
+            yield item
+
+    def close(self, discard=False):
+        """Stop accepting items; with ``discard`` also drop the queued ones."""
+        with self.lock:
+            self.closed = True
+            items = []
+            if discard:
+                items = [item for kind, item in self.items]
+                self.items.clear()
+            self.lock.notify_all()
+        if self.discard is not None:
+            for item in items:
+                self.discard(item)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.dropped)
+            stats.update(
+                depth=len(self.items),
+                queued=self.queued,
+                high_water=self.high_water,
+                blocked=self.blocked,
+            )
+        return stats
@@ -0,0 +1,478 @@
+import heapq
+import json
+import logging
+import random
+import selectors
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from itertools import count
+from dvrip import SomethingIsWrongWithCamera
+from dvrip_codec import codec, templates
+from dvrip_framing import (
+    HEADER_SIZE,
+    JPEG,
+    MEDIA_TYPE,
+    build_packet,
+    media_header_size,
+    parse_media_header,
+    unpack_header,
+)
+
+MEDIA_PREFIX = b"\x00\x00\x01"
+
+
+class Channel(object):
+    """Framing state of one camera socket owned by a Reactor."""
+
+    def __init__(self, reactor, cam, on_reply, on_frame, on_alarm, on_dead, keepalive=True):
+        self.reactor = reactor
+        self.cam = cam
+        self.sock = cam.socket
+        self.on_reply = on_reply
+        self.on_frame = on_frame
+        self.on_alarm = on_alarm
+        self.on_dead = on_dead
+        self.keepalive = keepalive
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.pending = OrderedDict()
+        self.events = selectors.EVENT_READ
+        self.last_rx = time.time()
+        self.closed = False
+        # media frame being reassembled
+        self.frame = None
+        self.meta = None
+        self.remaining = 0
+
+    def cancel(self):
+        # installed as cam.alive, so DVRIPCam.close() detaches the session
+        self.reactor.remove(self.cam)
+
+
+class Reactor(object):
+    """Drives many DVRIPCam sessions from a single selector loop.
+
+    add() takes over the socket of a logged-in session: it is switched to
+    non-blocking mode, replies are matched to the futures returned by
+    request(), media frames are reassembled and passed to
+    ``on_frame(cam, frame, meta)``, alarms to ``on_alarm(cam, alarm, seq)``
+    and any other reply to ``on_reply(cam, msgid, reply)``. KeepAlive is sent
+    from the same loop, and a session that stays silent for two keep-alive
+    intervals is reported to ``on_dead(cam)`` and closed.
+    """
+
+    def __init__(self, on_reply=None, on_frame=None, on_alarm=None, on_dead=None, jitter=0.2):
+        self.logger = logging.getLogger(__name__)
+        self.on_reply = on_reply
+        self.on_frame = on_frame
+        self.on_alarm = on_alarm
+        self.on_dead = on_dead
+        self.jitter = jitter
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.channels = {}  # id(cam) -> Channel
+        self.dirty = set()
+        self.added = []
+        self.removed = []
+        self.timers = []
+        self.order = count()
+        self.running = False
+        self.thread = None
+        self.waker, self.wake_writer = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ, None)
+
+    def add(
+        self, cam, on_reply=None, on_frame=None, on_alarm=None, on_dead=None, keepalive=True
+    ):
+        """Attach a session; with ``keepalive`` False (media sockets) the
+        loop only watches it for silence instead of sending KeepAlive."""
+        if cam.socket is None:
+            raise SomethingIsWrongWithCamera("Session is not connected")
+        if cam.pending is not None:
+            raise SomethingIsWrongWithCamera("Session is multiplexed already")
+        if cam.alive is not None:
+            cam.alive.cancel()
+        ch = Channel(
+            self,
+            cam,
+            on_reply or self.on_reply,
+            on_frame or self.on_frame,
+            on_alarm or self.on_alarm,
+            on_dead or self.on_dead,
+            keepalive,
+        )
+        cam.alive = ch
+        ch.sock.setblocking(False)
+        with self.lock:
+            self.channels[id(cam)] = ch
+            self.added.append(ch)
+        self.wake()
+        return ch
+
+    def remove(self, cam):
+        with self.lock:
+            ch = self.channels.pop(id(cam), None)
+            if ch is None:
+                return
+            ch.closed = True
+            self.removed.append(ch)
+        self.wake()
+
+    def request(self, cam, msg, data={}):
+        future = Future()
+        if not isinstance(data, (bytes, bytearray)):
+            data = codec.dumps(data)
+        with self.lock:
+            ch = self.channels.get(id(cam))
+            if ch is None:
+                future.set_exception(SomethingIsWrongWithCamera("Session is not attached"))
+                return future
+            sequence_number = cam.packet_count
+            cam.packet_count += 1
+            ch.pending[sequence_number] = (msg + 1, future)
+            ch.outbuf += build_packet(msg, data, cam.session, sequence_number)
+            self.dirty.add(ch)
+        self.wake()
+        return future
+
+    def get_command(self, cam, command, code=None):
+        if not code:
+            code = cam.QCODES[command]
+        return self.request(cam, code, templates.command(command).render(cam.session))
+
+    def get_info(self, cam, command):
+        return self.get_command(cam, command, 1042)
+
+    def wake(self):
+        if threading.current_thread() is self.thread:
+            return
+        try:
+            self.wake_writer.send(b"\x00")
+        except (BlockingIOError, OSError):
+            pass
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(name="DVRReactor", target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self):
+        self.running = True
+        self.thread = threading.current_thread()
+        while self.running:
+            self.run_once()
+
+    def run_once(self, timeout=1.0):
+        # selector changes and writes only ever happen on the loop thread
+        with self.lock:
+            added, self.added = self.added, []
+            dirty, self.dirty = self.dirty, set()
+            removed, self.removed = self.removed, []
+        for ch in added:
+            if not ch.closed:
+                self.selector.register(ch.sock, ch.events, ch)
+                self.schedule(ch, ch.cam.alive_time)
+        for ch in removed:
+            self.detach(ch)
+        for ch in dirty:
+            if not ch.closed:
+                self.flush(ch)
+        if self.added or self.dirty or self.removed:
+            timeout = 0
+        elif self.timers:
+            timeout = max(0, min(timeout, self.timers[0][0] - time.time()))
+        for key, mask in self.selector.select(timeout):
+            ch = key.data
+            if ch is None:
+                try:
+                    while self.waker.recv(4096):
+                        pass
+                except (BlockingIOError, OSError):
+                    pass
+                continue
+            if ch.closed:
+                continue
+            try:
+                if mask & selectors.EVENT_READ:
+                    self.read(ch)
+                if mask & selectors.EVENT_WRITE and not ch.closed:
+                    self.flush(ch)
+            except Exception:
+                # a bad packet or a failing callback only costs its session
+                self.logger.exception("Dropping session %08X to %s", ch.cam.session, ch.cam.ip)
+                self.dead(ch)
+        self.run_timers()
+
+    def detach(self, ch, restore=True):
+        try:
+            self.selector.unregister(ch.sock)
+        except (KeyError, ValueError, OSError):
+            pass
+        for reply_id, future in ch.pending.values():
+            if not future.done():
+                future.set_exception(SomethingIsWrongWithCamera("Session detached"))
+        ch.pending.clear()
+        if ch.cam.alive is ch:
+            ch.cam.alive = None
+        try:
+            ch.sock.settimeout(ch.cam.timeout)
+        except OSError:
+            pass
+        if restore and ch.cam.socket is not None:
+            # back to blocking use, add() cancelled its keep-alive
+            ch.cam.keep_alive()
+
+    def dead(self, ch):
+        if ch.closed:
+            return
+        self.logger.debug("Session %08X to %s is dead", ch.cam.session, ch.cam.ip)
+        with self.lock:
+            self.channels.pop(id(ch.cam), None)
+            ch.closed = True
+        self.detach(ch, restore=False)
+        ch.cam.close()
+        if ch.on_dead is not None:
+            try:
+                ch.on_dead(ch.cam)
+            except Exception:
+                self.logger.exception("on_dead failed for %s", ch.cam.ip)
+
+    def flush(self, ch):
+        with self.lock:
+            try:
+                sent = ch.sock.send(ch.outbuf)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                sent = -1
+            if sent > 0:
+                del ch.outbuf[:sent]
+            events = selectors.EVENT_READ
+            if ch.outbuf:
+                events |= selectors.EVENT_WRITE
+            if sent >= 0 and events != ch.events:
+                ch.events = events
+                self.selector.modify(ch.sock, events, ch)
+        if sent < 0:
+            self.dead(ch)
+
+    def read(self, ch):
+        while True:
+            try:
+                data = ch.sock.recv(0x40000)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                data = b""
+            if not data:
+                self.dead(ch)
+                return
+            ch.inbuf += data
+            if len(data) < 0x40000:
+                break
+        ch.last_rx = time.time()
+        self.parse(ch)
+
+    def parse(self, ch):
+        buf = ch.inbuf
+        end = len(buf)
+        pos = 0
+        view = memoryview(buf)
+        try:
+            while end - pos >= HEADER_SIZE:
+                header = unpack_header(buf, pos)
+                stop = pos + HEADER_SIZE + header.length
+                if stop > end:
+                    break
+                self.dispatch(ch, header, view[pos + HEADER_SIZE : stop])
+                pos = stop
+        finally:
+            view.release()
+        if pos:
+            del buf[:pos]
+
+    def dispatch(self, ch, header, body):
+        if ch.remaining or header.msgid == 1412 or body[:3] == MEDIA_PREFIX:
+            self.media(ch, body)
+            return
+        (data_type,) = MEDIA_TYPE.unpack_from(body) if len(body) >= 4 else (0,)
+        if data_type == JPEG:
+            self.media(ch, body)
+            return
+        try:
+            reply = codec.loads(bytes(body).rstrip(b"\x00").rstrip(b"\n"))
+        except ValueError:
+            reply = {"Ret": 101}
+        cam = ch.cam
+        if header.msgid == cam.QCODES["AlarmInfo"] and header.session == cam.session:
+            alarm = reply.get(reply.get("Name"))
+            if alarm is None:
+                self.logger.debug("Ignoring malformed alarm from %s: %s", cam.ip, reply)
+            elif ch.on_alarm is not None:
+                ch.on_alarm(cam, alarm, header.sequence)
+            return
+        future = self.take_pending(ch, header.sequence, header.msgid)
+        if future is not None:
+            future.set_result(reply)
+        elif ch.on_reply is not None:
+            ch.on_reply(cam, header.msgid, reply)
+
+    def take_pending(self, ch, sequence_number, msgid):
+        with self.lock:
+            entry = ch.pending.get(sequence_number)
+            if entry is not None and entry[0] == msgid:
+                return ch.pending.pop(sequence_number)[1]
+            for key, (reply_id, future) in ch.pending.items():
+                if reply_id == msgid:
+                    return ch.pending.pop(key)[1]
+        return None
+
+    def media(self, ch, body):
+        offset = 0
+        if not ch.remaining:
+            (data_type,) = MEDIA_TYPE.unpack_from(body)
+            # special case of JPEG shapshots
+            if data_type == JPEG:
+                self.deliver(ch, bytes(body), {"type": "jpeg"})
+                return
+            ch.meta = {}
+            offset = media_header_size(data_type)
+            ch.remaining = parse_media_header(data_type, body, ch.meta)
+            ch.frame = bytearray()
+        ch.frame += body[offset:]
+        ch.remaining -= len(body) - offset
+        if ch.remaining <= 0:
+            frame, meta = ch.frame, ch.meta
+            ch.frame = ch.meta = None
+            ch.remaining = 0
+            self.deliver(ch, frame, meta)
+
+    def deliver(self, ch, frame, meta):
+        if ch.on_frame is not None:
+            ch.on_frame(ch.cam, frame, meta)
+
+    def schedule(self, ch, interval):
+        delay = interval * (1 - self.jitter * random.random())
+        heapq.heappush(self.timers, (time.time() + delay, next(self.order), ch))
+
+    def run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            due, order, ch = heapq.heappop(self.timers)
+            if ch.closed:
+                continue
+            cam = ch.cam
+            if now - ch.last_rx > 2 * cam.alive_time:
+                self.dead(ch)
+                continue
+            if not ch.keepalive:
+                self.schedule(ch, cam.alive_time)
+                continue
+            self.request(
+                cam,
+                cam.QCODES["KeepAlive"],
+                templates.command("KeepAlive").render(cam.session),
+            )
+            self.schedule(ch, cam.alive_time)
+
+
+def benchmark(counts=(10, 50, 100, 200, 400), seconds=5):
+    """CPU time of the reactor process per camera for growing fleets.
+
+    Every simulated camera answers one request and raises one alarm per
+    second; the simulators run in a forked child so only the reactor side
+    is measured.
+    """
+    import os
+    from dvrip import DVRIPCam
+
+    def camera_side(socks):
+        sel = selectors.DefaultSelector()
+        for s in socks:
+            s.setblocking(False)
+            sel.register(s, selectors.EVENT_READ, bytearray())
+        alarm = json.dumps({"Name": "AlarmInfo", "AlarmInfo": {"Event": "MotionDetect"}}).encode()
+        next_alarm = time.time() + 1
+        while True:
+            for key, mask in sel.select(0.1):
+                try:
+                    data = key.fileobj.recv(65536)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    return
+                buf = key.data
+                buf += data
+                while len(buf) >= HEADER_SIZE:
+                    header = unpack_header(buf)
+                    if len(buf) < HEADER_SIZE + header.length:
+                        break
+                    del buf[: HEADER_SIZE + header.length]
+                    reply = json.dumps({"Ret": 100, "Name": "", "SessionID": "0x00000001"}).encode()
+                    key.fileobj.sendall(build_packet(header.msgid + 1, reply, 1, header.sequence))
+            if time.time() >= next_alarm:
+                next_alarm += 1
+                for s in socks:
+                    s.sendall(build_packet(1504, alarm, 1, 0))
+
+    print(f"{'cameras':>8} {'cpu ms/s':>10} {'per camera':>12} {'msgs/s':>8}")
+    for n in counts:
+        pairs = [socket.socketpair() for _ in range(n)]
+        pid = os.fork()
+        if pid == 0:
+            for a, b in pairs:
+                a.close()
+            camera_side([b for a, b in pairs])
+            os._exit(0)
+        received = [0]
+
+        def on_alarm(cam, alarm, seq):
+            received[0] += 1
+
+        reactor = Reactor(on_alarm=on_alarm)
+        cams = []
+        for a, b in pairs:
+            b.close()
+            cam = DVRIPCam("127.0.0.1")
+            cam.socket = a
+            cam.session = 1
+            cam.timeout = 10
+            reactor.add(cam)
+            cams.append(cam)
+        reactor.start()
+        start_cpu = time.process_time()
+        start = time.time()
+        while time.time() - start < seconds:
+            futures = [reactor.get_info(cam, "General") for cam in cams]
+            for future in futures:
+                future.result(10)
+                received[0] += 1
+            time.sleep(max(0, 1 - (time.time() - start) % 1))
+        cpu = time.process_time() - start_cpu
+        elapsed = time.time() - start
+        reactor.stop()
+        for cam in cams:
+            cam.socket.close()
+        os.waitpid(pid, 0)
+        print(
+            f"{n:8d} {cpu / elapsed * 1000:10.1f} {cpu / elapsed / n * 1e6:10.0f}us"
+            f" {received[0] / elapsed:8.0f}"
+        )
+
+
+if __name__ == "__main__":
+    import sys
+
+    benchmark([int(x) for x in sys.argv[1:]] or (10, 50, 100, 200, 400))
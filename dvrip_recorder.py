@@ -0,0 +1,465 @@
+import os
+import struct
+import threading
+import time
+import logging
+from collections import deque, namedtuple
+from pathlib import Path
+from dvrip_framing import datetime_to_internal, internal_to_datetime
+from dvrip_ts import TSMuxer
+
+# keyframe index written next to every video segment: one record per
+# I-frame with its byte offset in the video file, the raw camera datetime
+# and the size of the frame as written
+INDEX = struct.Struct("<QII")
+
+IndexEntry = namedtuple("IndexEntry", ["offset", "datetime", "size"])
+
+
+class WriteBehind(object):
+    """Buffered file writes done by a background thread.
+
+    write() only appends to an in-memory buffer per file; buffers of
+    ``buffer_size`` bytes, or older than ``flush_interval`` seconds, are
+    written by the writer thread, so a slow disk never blocks the caller
+    until ``max_pending`` bytes are waiting. ``fsync`` is None (leave it to
+    the OS), "segment" (fsync every file before it is closed) or a number
+    of seconds between fsyncs of the open files.
+    """
+
+    def __init__(self, buffer_size=1 << 20, max_pending=64 << 20, fsync="segment", flush_interval=1.0):
+        self.logger = logging.getLogger(__name__)
+        self.buffer_size = buffer_size
+        self.max_pending = max_pending
+        self.fsync = fsync
+        self.flush_interval = flush_interval
+        self.lock = threading.Condition()
+        self.ops = deque()
+        self.buffers = {}  # name -> bytearray not handed to the thread yet
+        self.dirty = {}  # name -> time the first byte went into its buffer
+        self.files = {}  # name -> open file, used by the writer thread only
+        self.pending = 0
+        self.written = 0
+        self.blocked = 0.0
+        self.error = None
+        self.running = True
+        self.last_sync = time.time()
+        self.thread = threading.Thread(name="DVRWriter", target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def open(self, name, path):
+        """Write the following data of ``name`` to a new file at ``path``."""
+        with self.lock:
+            self.queue_buffer(name)
+            self.ops.append(("open", name, path))
+            self.lock.notify_all()
+
+    def write(self, name, data):
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            if self.pending >= self.max_pending:
+                start = time.time()
+                self.logger.warning("Disk is behind by %d bytes", self.pending)
+                while self.pending >= self.max_pending and self.error is None:
+                    self.lock.wait()
+                self.blocked += time.time() - start
+            buf = self.buffers.get(name)
+            if buf is None:
+                buf = self.buffers[name] = bytearray()
+                self.dirty[name] = time.time()
+                # the writer thread computes its next flush from this
+                self.lock.notify_all()
+            buf += data
+            self.pending += len(data)
+            if len(buf) >= self.buffer_size:
+                self.queue_buffer(name)
+                self.lock.notify_all()
+
+    def close(self, name=None):
+        """Close the file of ``name``, or all files."""
+        with self.lock:
+            for n in [name] if name is not None else list(self.buffers):
+                self.queue_buffer(n)
+            self.ops.append(("close", name, None))
+            self.lock.notify_all()
+
+    def queue_buffer(self, name):
+        self.dirty.pop(name, None)
+        buf = self.buffers.pop(name, None)
+        if buf:
+            self.ops.append(("write", name, buf))
+
+    def queue_old(self):
+        # by age on every pass: steady writes to one file keep notifying
+        # the writer thread, its wait alone would never time out
+        now = time.time()
+        for name, since in list(self.dirty.items()):
+            if now - since >= self.flush_interval:
+                self.queue_buffer(name)
+        if self.dirty:
+            return max(min(self.dirty.values()) + self.flush_interval - now, 0.01)
+        return None
+
+    def flush(self):
+        """Hand all buffers to the writer thread and wait until written."""
+        with self.lock:
+            for name in list(self.buffers):
+                self.queue_buffer(name)
+            self.lock.notify_all()
+            while (self.ops or self.pending) and self.error is None and self.thread.is_alive():
+                self.lock.wait(0.1)
+
+    def stop(self):
+        self.close()
+        self.flush()
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.lock:
+                timeout = self.queue_old()
+                if not self.ops and self.running:
+                    self.lock.wait(timeout)
+                    self.queue_old()
+                if not self.ops:
+                    if not self.running:
+                        return
+                    continue
+                op, name, arg = self.ops.popleft()
+            try:
+                self.apply(op, name, arg)
+            except OSError as e:
+                self.logger.error("Write to %s failed: %s", name, e)
+                with self.lock:
+                    self.error = e
+                    self.lock.notify_all()
+                return
+            if op == "write":
+                with self.lock:
+                    self.pending -= len(arg)
+                    self.written += len(arg)
+                    self.lock.notify_all()
+
+    def apply(self, op, name, arg):
+        if op == "write":
+            f = self.files[name]
+            f.write(arg)
+            # buffers are batched here already, a small one that aged out
+            # must not wait in the file object's buffer
+            f.flush()
+            if isinstance(self.fsync, (int, float)) and time.time() - self.last_sync >= self.fsync:
+                for f in self.files.values():
+                    self.sync(f)
+                self.last_sync = time.time()
+        elif op == "open":
+            self.close_file(name)
+            Path(arg).parent.mkdir(parents=True, exist_ok=True)
+            self.files[name] = open(arg, "wb")
+        elif op == "close":
+            for n in [name] if name is not None else list(self.files):
+                self.close_file(n)
+
+    def close_file(self, name):
+        f = self.files.pop(name, None)
+        if f is None:
+            return
+        if self.fsync is not None:
+            self.sync(f)
+        f.close()
+
+    def sync(self, f):
+        f.flush()
+        os.fsync(f.fileno())
+
+    def stats(self):
+        with self.lock:
+            return {"pending": self.pending, "written": self.written, "blocked": self.blocked}
+
+
+class Recorder(object):
+    """start_monitor() callback that records a stream into segments.
+
+    Every segment starts with an I-frame: frames before the first I-frame
+    are skipped, and a new segment is started at the first I-frame after
+    the current one is ``chunk`` seconds old. ``mkpath()`` returns the path
+    of a new segment without extension; video and audio go to
+    ``path.video`` and ``path.audio`` through a WriteBehind writer, so the
+    callback itself only copies the frame into memory. With ``container``
+    "ts" the video is muxed into a playable ``path.ts`` instead, audio
+    stays raw G.711. Every I-frame is also recorded in ``path.idx``, see
+    KeyframeIndex.
+    """
+
+    def __init__(self, mkpath, chunk=600, writer=None, on_segment=None, container="raw"):
+        if container not in ("raw", "ts"):
+            raise ValueError(f"Unknown container {container}")
+        self.mkpath = mkpath
+        self.chunk = chunk
+        self.writer = writer or WriteBehind()
+        self.muxer = TSMuxer() if container == "ts" else None
+        self.extension = ".ts" if container == "ts" else ".video"
+        self.on_segment = on_segment
+        self.path = None
+        self.started = 0
+        self.offset = 0
+
+    def __call__(self, frame, meta, user=None):
+        self.write(frame, meta)
+
+    def write(self, frame, meta):
+        if frame is None:
+            return
+        kind = meta.get("frame")
+        if kind == "I" and (self.path is None or time.time() - self.started >= self.chunk):
+            self.rotate()
+        if self.path is None:
+            return
+        # zero-copy frames are ArenaBuffers, copy their bytes
+        frame = getattr(frame, "view", frame)
+        if kind is not None:
+            if self.muxer is not None:
+                frame = self.muxer.mux(frame, meta)
+            if kind == "I" and "datetime" in meta:
+                self.writer.write(
+                    "index",
+                    INDEX.pack(self.offset, datetime_to_internal(meta["datetime"]), len(frame)),
+                )
+            self.writer.write("video", frame)
+            self.offset += len(frame)
+        elif meta.get("type") == "g711a":
+            self.writer.write("audio", frame)
+
+    def rotate(self):
+        self.path = self.mkpath()
+        self.started = time.time()
+        self.offset = 0
+        self.writer.open("video", self.path + self.extension)
+        self.writer.open("index", self.path + ".idx")
+        self.writer.open("audio", self.path + ".audio")
+        if self.on_segment is not None:
+            self.on_segment(self.path)
+
+    def close(self):
+        self.path = None
+        self.writer.stop()
+
+
+class KeyframeIndex(object):
+    """Read access to the ``.idx`` sidecar of a recorded video file.
+
+    Lookups bisect the fixed-width records on disk, so finding a time in
+    an archive costs a few seeks whatever its length.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.count = os.fstat(self.file.fileno()).st_size // INDEX.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        self.file.seek(i * INDEX.size)
+        offset, dt, size = INDEX.unpack(self.file.read(INDEX.size))
+        return IndexEntry(offset, internal_to_datetime(dt), size)
+
+    def bisect(self, when):
+        """Number of keyframes at or before ``when``."""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid].datetime <= when:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, start, end):
+        """Byte range of the video covering ``start`` to ``end``.
+
+        The range begins at the keyframe preceding ``start`` and ends before
+        the first keyframe after ``end``; None as end means end of file.
+        """
+        if not self.count:
+            return None, None
+        first = max(self.bisect(start) - 1, 0)
+        last = self.bisect(end)
+        stop = self[last].offset if last < self.count else None
+        return self[first].offset, stop
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def extract(video, start, end, out, chunk=1 << 20):
+    """Copy the part of a recorded ``video`` file from ``start`` to ``end``.
+
+    Seeks straight to the keyframe preceding ``start`` using the ``.idx``
+    sidecar, so the cost depends on the clip length only. ``out`` is a path
+    or a binary file object. Returns the number of bytes copied.
+    """
+    with KeyframeIndex(os.path.splitext(video)[0] + ".idx") as index:
+        begin, stop = index.range(start, end)
+    if begin is None:
+        return 0
+    close = isinstance(out, (str, Path))
+    if close:
+        out = open(out, "wb")
+    copied = 0
+    try:
+        with open(video, "rb") as f:
+            f.seek(begin)
+            while stop is None or begin + copied < stop:
+                size = chunk if stop is None else min(chunk, stop - begin - copied)
+                data = f.read(size)
+                if not data:
+                    break
+                out.write(data)
+                copied += len(data)
+    finally:
+        if close:
+            out.close()
+    return copied
+
+
+class PreEventBuffer(object):
+    """start_monitor() callback that keeps the last seconds of a stream.
+
+    Frames are copied into one buffer per GOP: the oldest GOP is dropped
+    once the next one already covers ``pre`` seconds, or when the GOP
+    buffers take more than ``max_bytes``. The buffer of a dropped GOP is
+    reused for the next one. trigger() writes the buffered pre-roll and
+    the following ``post`` seconds into a clip at ``mkpath()`` through a
+    Recorder; a trigger during a clip extends it. alarm() can be passed to
+    setAlarm() of a second session of the camera. ``on_clip(path)`` is
+    called when a clip is complete.
+    """
+
+    def __init__(
+        self, mkpath, pre=20, post=10, max_bytes=32 << 20, writer=None, container="raw", on_clip=None
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.mkpath = mkpath
+        self.pre = pre
+        self.post = post
+        self.max_bytes = max_bytes
+        self.writer = writer or WriteBehind()
+        self.container = container
+        self.on_clip = on_clip
+        self.lock = threading.Lock()
+        self.gops = deque()  # [arrival time, buffer, used, [(offset, length, meta), ...]]
+        self.spare = None  # buffer of the last dropped GOP
+        self.size = 0  # allocated bytes of the GOP buffers
+        self.clip = None
+        self.path = None
+        self.until = 0
+
+    def __call__(self, frame, meta, user=None):
+        self.write(frame, meta)
+
+    def write(self, frame, meta):
+        if frame is None:
+            return
+        now = time.monotonic()
+        finished = None
+        with self.lock:
+            if self.clip is not None:
+                if now < self.until or meta.get("frame") == "P":
+                    self.clip.write(frame, meta)
+                else:
+                    finished = self.finish()
+            self.buffer(frame, meta, now)
+        if finished is not None and self.on_clip is not None:
+            self.on_clip(finished)
+
+    def buffer(self, frame, meta, now):
+        if meta.get("frame") == "I":
+            buf, self.spare = self.spare or bytearray(), None
+            self.size += len(buf)
+            self.gops.append([now, buf, 0, []])
+        elif not self.gops:
+            return
+        # copied, holding on to zero-copy frames would pin a whole arena
+        # block per frame
+        data = getattr(frame, "view", frame)
+        gop = self.gops[-1]
+        buf, used = gop[1], gop[2]
+        end = used + len(data)
+        if end > len(buf):
+            grow = max(end - len(buf), len(buf))
+            buf.extend(bytes(grow))
+            self.size += grow
+        buf[used:end] = data
+        gop[2] = end
+        gop[3].append((used, len(data), meta))
+        while len(self.gops) > 1 and (
+            self.gops[1][0] <= now - self.pre or self.size > self.max_bytes
+        ):
+            self.evict()
+        if self.size > self.max_bytes:
+            # a single GOP over the limit, wait for the next I-frame
+            self.logger.warning("GOP is larger than %d bytes", self.max_bytes)
+            self.evict()
+
+    def evict(self):
+        _, buf, _, _ = self.gops.popleft()
+        self.size -= len(buf)
+        if len(buf) <= self.max_bytes // 2:
+            self.spare = buf
+
+    def trigger(self, reason=None):
+        """Start a clip with the pre-roll, or extend the running one."""
+        with self.lock:
+            self.until = time.monotonic() + self.post
+            if self.clip is not None:
+                return self.path
+            self.path = self.mkpath()
+            self.logger.info("Recording clip %s (%s)", self.path, reason)
+            path = self.path
+            self.clip = Recorder(
+                lambda: path, float("inf"), self.writer, container=self.container
+            )
+            for _, buf, _, frames in self.gops:
+                with memoryview(buf) as view:
+                    for offset, length, meta in frames:
+                        with view[offset : offset + length] as frame:
+                            self.clip.write(frame, meta)
+            return self.path
+
+    def alarm(self, info, sequence=None):
+        """setAlarm() callback triggering a clip."""
+        self.trigger(info)
+
+    def finish(self):
+        path, self.path, self.clip = self.path, None, None
+        self.writer.close()
+        return path
+
+    def stats(self):
+        with self.lock:
+            return {"gops": len(self.gops), "bytes": self.size, "recording": self.path}
+
+    def close(self):
+        with self.lock:
+            finished = self.finish() if self.clip is not None else None
+            self.gops.clear()
+            self.spare = None
+            self.size = 0
+        self.writer.stop()
+        if finished is not None and self.on_clip is not None:
+            self.on_clip(finished)
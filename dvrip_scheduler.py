@@ -0,0 +1,256 @@
+import heapq
+import threading
+import time
+import logging
+from datetime import datetime
+from itertools import count
+from dvrip_download import TIME_FORMAT
+from dvrip_pool import SessionPool
+
+
+class TokenBucket(object):
+    """Byte rate limit shared by threads, consume() blocks until allowed."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # go into debt instead of splitting large packets, the next
+            # caller waits for it to be paid back
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class DownloadJob(object):
+    """One recording of a camera, as queued in a DownloadScheduler."""
+
+    def __init__(self, camera, file, path, seq, channel=0):
+        self.camera = camera  # (ip, port, user)
+        self.file = file
+        self.path = path
+        # resumes are requested ByTime, which selects the channel
+        self.channel = int(file.get("Channel", channel))
+        self.seq = seq
+        self.attempts = 0
+        self.due = 0
+        self.error = None
+        # newest first, then in the order added
+        begin = datetime.strptime(file["BeginTime"], TIME_FORMAT)
+        self.priority = (-begin.timestamp(), seq)
+
+    def __lt__(self, other):
+        return self.priority < other.priority
+
+
+class CameraStats(object):
+    __slots__ = ("queued", "active", "done", "failed", "bytes", "busy", "started")
+
+    def __init__(self):
+        self.queued = self.active = self.done = self.failed = self.bytes = 0
+        self.busy = 0.0  # seconds with at least one download running
+        self.started = None
+
+    def as_dict(self, now):
+        busy = self.busy + (now - self.started if self.started is not None else 0)
+        return {
+            "queued": self.queued,
+            "active": self.active,
+            "done": self.done,
+            "failed": self.failed,
+            "bytes": self.bytes,
+            "rate": self.bytes / busy if busy else 0.0,
+        }
+
+
+class DownloadScheduler(object):
+    """Download recordings from many cameras in parallel.
+
+    add() queues files of a camera. ``workers`` threads download them with
+    at most ``per_camera`` playback sessions per camera, most cameras allow
+    only one or two, and all of them together within ``bandwidth`` bytes
+    per second when given. The newest recording that a camera has a free
+    slot for goes first. A failed download is retried ``retries`` times,
+    ``retry_delay`` seconds later each time, and continues where it broke
+    off (download_file(resume=True)). Sessions come from ``pool``.
+    ``on_done(job)`` runs on the worker thread after every download, with
+    ``job.error`` set when it finally failed.
+    """
+
+    def __init__(
+        self,
+        pool=None,
+        workers=8,
+        per_camera=1,
+        bandwidth=None,
+        retries=3,
+        retry_delay=30,
+        on_done=None,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.pool = pool or SessionPool(max_per_camera=per_camera)
+        self.workers = workers
+        self.per_camera = per_camera
+        self.bucket = TokenBucket(bandwidth) if bandwidth else None
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.on_done = on_done
+        self.lock = threading.Condition()
+        self.queues = {}  # camera -> heap of DownloadJob
+        self.delayed = []  # jobs waiting for a retry
+        self.cameras = {}  # camera -> CameraStats
+        self.credentials = {}
+        self.seq = count()
+        self.threads = []
+        self.running = False
+        self.started = None
+
+    def add(
+        self, ip, files, path, port=None, user="admin", password=None, hash_pass=None, channel=0
+    ):
+        """Queue ``files`` of OPFileQuery, ``path(file)`` is the target path.
+
+        The "Channel" of a file (as in RecordingCatalog.files()) overrides
+        ``channel``.
+        """
+        camera = self.pool.key(ip, port, user)
+        with self.lock:
+            self.credentials[camera] = (password, hash_pass)
+            stats = self.cameras.setdefault(camera, CameraStats())
+            queue = self.queues.setdefault(camera, [])
+            for file in files:
+                heapq.heappush(
+                    queue, DownloadJob(camera, file, path(file), next(self.seq), channel)
+                )
+                stats.queued += 1
+            self.lock.notify_all()
+
+    def start(self):
+        self.running = True
+        self.started = time.monotonic()
+        for i in range(self.workers):
+            thread = threading.Thread(name="DVRDownload%d" % i, target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def join(self):
+        """Wait until every queued file is downloaded or failed."""
+        with self.lock:
+            while self.running and any(
+                s.queued or s.active for s in self.cameras.values()
+            ):
+                self.lock.wait(1)
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def run(self):
+        while True:
+            with self.lock:
+                job = self.next_job()
+                while job is None and self.running:
+                    self.lock.wait(self.wait_time())
+                    job = self.next_job()
+                if job is None:
+                    return
+                stats = self.cameras[job.camera]
+                stats.queued -= 1
+                stats.active += 1
+                if stats.started is None:
+                    stats.started = time.monotonic()
+            try:
+                self.download(job, stats)
+                job.error = None
+            except Exception as e:
+                job.error = e
+            with self.lock:
+                stats.active -= 1
+                if not stats.active:
+                    stats.busy += time.monotonic() - stats.started
+                    stats.started = None
+                if job.error is not None and job.attempts <= self.retries:
+                    self.logger.debug("Retrying %s: %s", job.path, job.error)
+                    job.due = time.monotonic() + self.retry_delay * job.attempts
+                    self.delayed.append(job)
+                    stats.queued += 1
+                    job = None
+                elif job.error is not None:
+                    self.logger.warning("Giving up on %s: %s", job.path, job.error)
+                    stats.failed += 1
+                else:
+                    stats.done += 1
+                self.lock.notify_all()
+            if job is not None and self.on_done is not None:
+                self.on_done(job)
+
+    def next_job(self):
+        now = time.monotonic()
+        for job in [j for j in self.delayed if j.due <= now]:
+            self.delayed.remove(job)
+            heapq.heappush(self.queues[job.camera], job)
+        best = None
+        for camera, queue in self.queues.items():
+            if queue and self.cameras[camera].active < self.per_camera:
+                if best is None or queue[0] < best[0]:
+                    best = queue[0], queue
+        if best is None:
+            return None
+        return heapq.heappop(best[1])
+
+    def wait_time(self):
+        if not self.delayed:
+            return None
+        return max(min(j.due for j in self.delayed) - time.monotonic(), 0.01)
+
+    def download(self, job, stats):
+        ip, port, user = job.camera
+        password, hash_pass = self.credentials[job.camera]
+        job.attempts += 1
+        last = [0]
+
+        def progress(received):
+            delta = received - last[0]
+            last[0] = received
+            with self.lock:
+                stats.bytes += delta
+            if self.bucket is not None:
+                self.bucket.consume(delta)
+
+        with self.pool.session(ip, port, user, password, hash_pass) as cam:
+            file = job.file
+            cam.download_file(
+                file["BeginTime"],
+                file["EndTime"],
+                file["FileName"],
+                job.path,
+                progress=progress,
+                resume=True,
+                channel=job.channel,
+            )
+
+    def stats(self):
+        """Progress and throughput (bytes/s) per "ip:port" and for all."""
+        now = time.monotonic()
+        with self.lock:
+            cameras = {
+                "%s:%d" % camera[:2]: s.as_dict(now) for camera, s in self.cameras.items()
+            }
+        total = {k: sum(c[k] for c in cameras.values()) for k in ("queued", "active", "done", "failed", "bytes")}
+        elapsed = now - self.started if self.started is not None else 0
+        total["rate"] = total["bytes"] / elapsed if elapsed else 0.0
+        return {"cameras": cameras, "total": total}
@@ -0,0 +1,183 @@
+import struct
+
+# MPEG transport stream muxer for the video elementary stream of a monitor
+# session. The cameras send Annex B H.264/H.265 without B-frames, so every
+# frame becomes one PES packet with PTS only. G.711 has no standard TS
+# stream type and is left to the raw .audio files.
+TS_SIZE = 188
+PAT_PID = 0x0000
+PMT_PID = 0x1000
+VIDEO_PID = 0x0100
+STREAM_TYPES = {"h264": 0x1B, "h265": 0x24}
+CLOCK = 90000
+PTS_MASK = (1 << 33) - 1
+
+
+def crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x04C11DB7 if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+
+CRC_TABLE = crc_table()
+
+
+def crc32(data):
+    """CRC-32/MPEG-2 of PSI sections."""
+    crc = 0xFFFFFFFF
+    for b in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ CRC_TABLE[(crc >> 24) ^ b]
+    return crc
+
+
+def pack_timestamp(marker, pts):
+    return bytes(
+        (
+            (marker << 4) | ((pts >> 29) & 0x0E) | 1,
+            (pts >> 22) & 0xFF,
+            ((pts >> 14) & 0xFE) | 1,
+            (pts >> 7) & 0xFF,
+            ((pts << 1) & 0xFE) | 1,
+        )
+    )
+
+
+def pack_pcr(base):
+    return struct.pack(">IH", (base >> 1) & 0xFFFFFFFF, ((base & 1) << 15) | 0x7E00)
+
+
+def section(table_id, extension, body):
+    # section_length counts the bytes after it up to and including the CRC
+    length = 5 + len(body) + 4
+    data = struct.pack(">BHHBBB", table_id, 0xB000 | length, extension, 0xC1, 0, 0) + body
+    return data + struct.pack(">I", crc32(data))
+
+
+class TSMuxer(object):
+    """Turns monitor frames into 188 byte MPEG-TS packets.
+
+    mux(frame, meta) takes the frame and metadata of start_monitor() and
+    returns the packets of one video frame. PAT and PMT are repeated before
+    every I-frame, which is flagged as random access point, so a file can
+    be cut at any I-frame. Timestamps advance by 1/fps per frame and are
+    pulled back to the camera clock at I-frames when they drift by more
+    than ``max_drift`` seconds, e.g. after dropped frames.
+    """
+
+    def __init__(self, fps=25, max_drift=1.5):
+        self.fps = fps
+        self.max_drift = max_drift
+        self.video = {}
+        self.counters = {}
+        self.clock = None
+        self.anchor = None
+        self.psi = None
+
+    def mux(self, frame, meta):
+        kind = meta.get("frame")
+        if kind is None:
+            return b""
+        if kind == "I":
+            self.video.update(meta)
+        stream_type = STREAM_TYPES.get(self.video.get("type"))
+        if stream_type is None:
+            return b""
+        pts = self.timestamp(kind)
+        out = bytearray()
+        if kind == "I":
+            out += self.tables(stream_type)
+        header = b"\x00\x00\x01\xE0\x00\x00\x80\x80\x05" + pack_timestamp(2, pts)
+        self.packetize(
+            out,
+            VIDEO_PID,
+            header,
+            memoryview(getattr(frame, "view", frame)),
+            (pts - CLOCK // 10) & PTS_MASK,
+            kind == "I",
+        )
+        return out
+
+    def timestamp(self, kind):
+        fps = self.video.get("fps") or self.fps
+        dt = self.video.get("datetime")
+        if self.clock is None:
+            self.clock = float(CLOCK)
+            self.anchor = (dt, self.clock)
+        else:
+            self.clock += CLOCK / fps
+        if kind == "I" and dt is not None and self.anchor[0] is not None:
+            expected = self.anchor[1] + (dt - self.anchor[0]).total_seconds() * CLOCK
+            if abs(self.clock - expected) > self.max_drift * CLOCK:
+                self.clock = expected
+        return int(self.clock) & PTS_MASK
+
+    def tables(self, stream_type):
+        if self.psi is None or self.psi[0] != stream_type:
+            pat = section(0x00, 1, struct.pack(">HH", 1, 0xE000 | PMT_PID))
+            pmt = section(
+                0x02,
+                1,
+                struct.pack(">HHBHH", 0xE000 | VIDEO_PID, 0xF000, stream_type, 0xE000 | VIDEO_PID, 0xF000),
+            )
+            self.psi = (stream_type, pat, pmt)
+        out = bytearray()
+        for pid, data in ((PAT_PID, self.psi[1]), (PMT_PID, self.psi[2])):
+            payload = b"\x00" + data
+            out += self.header(pid, True, 1)
+            out += payload + b"\xFF" * (184 - len(payload))
+        return out
+
+    def header(self, pid, start, control):
+        counter = self.counters.get(pid, 0)
+        self.counters[pid] = (counter + 1) & 0x0F
+        return struct.pack(
+            ">BHB", 0x47, (0x4000 if start else 0) | pid, (control << 4) | counter
+        )
+
+    def packetize(self, out, pid, header, payload, pcr=None, random_access=False):
+        """Append the packets of one PES packet to ``out``."""
+        pos = -len(header)  # negative while the PES header is not written
+        first = True
+        while pos < len(payload):
+            adaptation = b""
+            if first and (pcr is not None or random_access):
+                flags = (0x40 if random_access else 0) | (0x10 if pcr is not None else 0)
+                adaptation = bytes((flags,)) + (pack_pcr(pcr) if pcr is not None else b"")
+            left = len(payload) - pos
+            if not adaptation and left >= 184:
+                out += self.header(pid, first, 1)
+                size = 184
+            else:
+                # the last packet is filled up with adaptation field stuffing
+                if not adaptation and left < 183:
+                    adaptation = b"\x00"
+                size = min(left, 183 - len(adaptation))
+                stuffing = 183 - len(adaptation) - size
+                out += self.header(pid, first, 3)
+                out += bytes((len(adaptation) + stuffing,)) + adaptation + b"\xFF" * stuffing
+            if pos < 0:
+                out += header
+                size += pos
+                pos = 0
+            out += payload[pos : pos + size]
+            pos += size
+            first = False
+
+
+if __name__ == "__main__":
+    # muxing cost per second of a 4 Mbit/s 25 fps stream: python dvrip_ts.py
+    from datetime import datetime
+    from timeit import timeit
+
+    assert crc32(b"123456789") == 0x0376E6E7
+    muxer = TSMuxer()
+    iframe = {"frame": "I", "type": "h264", "fps": 25, "datetime": datetime(2023, 5, 1)}
+    pframe = {"frame": "P"}
+    frames = [(bytes(60000), iframe)] + [(bytes(18000), pframe)] * 24
+    n = 20
+    seconds = timeit(lambda: [muxer.mux(f, m) for f, m in frames], number=n) / n
+    print(f"{seconds * 1000:.1f} ms per second of video")
@@ -1,10 +1,11 @@
 #! /usr/bin/python3
-from dvrip import DVRIPCam, SomethingIsWrongWithCamera
+from dvrip import DVRIPCam, ReconnectPolicy, SomethingIsWrongWithCamera
+from dvrip_recorder import Recorder, WriteBehind
 from signal import signal, SIGINT, SIGTERM
 from sys import argv, stdout, exit
 from datetime import datetime
 from pathlib import Path
-from time import sleep, time
+from time import sleep
 import logging
 
 baseDir = argv[3]
@@ -15,6 +16,8 @@ camName = argv[2]
 cam = None
 isShuttingDown = False
 chunkSize = 600 # new file every 10 minutes
+fsyncPolicy = 'segment' # fsync on segment close; None, or seconds between fsyncs
+videoFormat = 'ts' # playable MPEG-TS video, or 'raw' for the elementary stream
 logFile = baseDir + '/' + camName + '/log.log'
 
 def log(str):
@@ -47,32 +50,33 @@ signal(SIGTERM, handler)
 def close():
     cam.close()
 
-def theActualJob():
-
-    prevtime = 0
-    video = None
-    audio = None
+def outage(cam, event, info):
+    if event == 'lost':
+        log('Connection lost, reconnecting...')
+    elif event == 'restored':
+        log('Reconnected after %.1fs (%d attempts)' % (info['outage'], info['attempts']))
+    elif event == 'failed':
+        log('Could not reconnect for %.1fs' % info['outage'])
 
-    def receiver(frame, meta, user):
-        nonlocal prevtime, video, audio
-        if frame is None:
-            log('Empty frame')
-        else:
-            tn = time()
-            if tn - prevtime >= chunkSize:
-                if video != None:
-                    video.close()
-                    audio.close()
-                prevtime = tn
-                path = mkpath()
-                log('Starting files: ' + path)
-                video = open(path + '.video', "wb")
-                audio = open(path + '.audio', "wb")
-            if 'type' in meta and meta["type"] == "g711a": audio.write(frame)
-            elif 'frame' in meta: video.write(frame)
+# a dropped connection is retried for about 10 minutes before starting over
+reconnect = ReconnectPolicy(initial=1, maximum=60, max_attempts=15)
+reconnect.add_listener(outage)
 
+def theActualJob():
+    # segments start at the first I-frame after chunkSize seconds, files are
+    # written by a background thread so a slow disk does not stall the stream
+    recorder = Recorder(
+        mkpath,
+        chunkSize,
+        WriteBehind(fsync=fsyncPolicy),
+        on_segment=lambda path: log('Starting files: ' + path),
+        container=videoFormat,
+    )
     log('Starting to grab streams...')
-    cam.start_monitor(receiver)
+    try:
+        cam.start_monitor(recorder)
+    finally:
+        recorder.close()
 
 def syncTime():
     log('Synching time...')
@@ -82,7 +86,7 @@ def syncTime():
 def jobWrapper():
     global cam
     log('Logging in to camera ' + camIp + '...')
-    cam = DVRIPCam(camIp)
+    cam = DVRIPCam(camIp, reconnect=reconnect)
     if cam.login():
         log('done')
     else:
@@ -36,10 +36,15 @@ setup(
         'Programming Language :: Python :: 3 :: Only',
     ],
 
-    py_modules=["dvrip", "DeviceManager", "asyncio_dvrip"],
+    py_modules=["dvrip", "dvrip_framing", "dvrip_pool", "dvrip_reactor", "dvrip_codec", "dvrip_queue", "dvrip_hub", "dvrip_multi", "dvrip_recorder", "dvrip_ts", "dvrip_audio", "dvrip_download", "dvrip_scheduler", "dvrip_catalog", "DeviceManager", "asyncio_dvrip"],
 
     python_requires='>=3.6',
 
+    extras_require={
+        'fast': ['orjson'],
+        'audio': ['numpy'],
+    },
+
     project_urls={
         'Bug Reports': 'https://github.com/NeiroNx/python-dvr/issues',
         'Source': 'https://github.com/NeiroNx/python-dvr',
@@ -10,19 +10,33 @@ class SolarCam:
     cam = None
     logger = None
 
-    def __init__(self, host_ip, user, password, logger):
+    def __init__(self, host_ip, user, password, logger, pool=None):
         self.logger = logger
-        self.cam = DVRIPCam(
-            host_ip,
-            user=user,
-            password=password,
-        )
+        self.pool = pool
+        self.host_ip = host_ip
+        self.user = user
+        self.password = password
+        if pool is None:
+            self.cam = DVRIPCam(
+                host_ip,
+                user=user,
+                password=password,
+            )
 
     def login(self, num_retries=10):
         for i in range(num_retries):
             try:
                 self.logger.debug("Try login...")
-                self.cam.login()
+                if self.pool is not None:
+                    cam = self.pool.checkout(
+                        self.host_ip, user=self.user, password=self.password
+                    )
+                    if cam is self.cam:
+                        self.logger.debug("Reusing logged in session")
+                        return
+                    self.cam = cam
+                else:
+                    self.cam.login()
                 self.logger.debug(
                     f"Success! Connected to Camera. Waiting few seconds to let Camera fully boot..."
                 )
@@ -31,7 +45,8 @@ class SolarCam:
                 return
             except SomethingIsWrongWithCamera:
                 self.logger.debug("Could not connect...Camera could be offline")
-                self.cam.close()
+                if self.pool is None:
+                    self.cam.close()
 
             if i == 9:
                 raise ConnectionRefusedError(
@@ -39,7 +54,10 @@ class SolarCam:
                 )
             sleep(2)
 
-    def logout(self):
+    def logout(self, discard=False):
+        if self.pool is not None:
+            self.pool.checkin(self.cam, discard=discard)
+            return
         self.cam.close()
 
     def get_time(self):
@@ -96,9 +114,14 @@ class SolarCam:
         Path(sourceFile).unlink()
         self.logger.debug(f"Orginal file successfully deleted: {sourceFile}")
 
-    def save_files(self, download_dir, files, blacklist=None, target_filetype=None):
-        self.logger.debug(f"Start downloading files")
+    def pending_files(
+        self, download_dir, files, blacklist=None, target_filetype=None, check=True
+    ):
+        """(file, target path, converted path or None) of files not yet downloaded.
 
+        With ``check`` False the files are taken as they are, without looking
+        at the disk or the blacklist.
+        """
         for file in files:
             target_file_path = self.generateTargetFilePath(
                 file["FileName"], download_dir
@@ -110,6 +133,10 @@ class SolarCam:
                     file["FileName"], download_dir, extention=f"{target_filetype}"
                 )
 
+            if not check:
+                yield file, target_file_path, target_file_path_convert
+                continue
+
             if Path(f"{target_file_path}").is_file():
                 self.logger.debug(f"File already exists: {target_file_path}")
                 continue
@@ -133,6 +160,14 @@ class SolarCam:
                     )
                     continue
 
+            yield file, target_file_path, target_file_path_convert
+
+    def save_files(self, download_dir, files, blacklist=None, target_filetype=None):
+        self.logger.debug(f"Start downloading files")
+
+        for file, target_file_path, target_file_path_convert in self.pending_files(
+            download_dir, files, blacklist, target_filetype
+        ):
             self.logger.debug(f"Downloading {target_file_path}...")
             self.cam.download_file(
                 file["BeginTime"], file["EndTime"], file["FileName"], target_file_path
@@ -140,12 +175,62 @@ class SolarCam:
             self.logger.debug(f"Finished downloading {target_file_path}...")
 
             if target_file_path_convert:
-                self.logger.debug(f"Converting {target_file_path_convert}...")
-                self.convertFile(target_file_path, target_file_path_convert)
-                self.logger.debug(f"Finished converting {target_file_path_convert}.")
+                self.convert(target_file_path, target_file_path_convert)
 
         self.logger.debug(f"Finish downloading files")
 
+    def sync_files(
+        self, catalog, download_dir, start, end, filetype, blacklist=None, target_filetype=None
+    ):
+        """Update the RecordingCatalog and return the files still to download.
+
+        Only files new to the catalog are checked against the disk and the
+        blacklist, the ones found there are marked skipped.
+        """
+        new = catalog.sync(self.cam, self.host_ip, filetype, start, end)
+        wanted = {
+            file["FileName"]
+            for file, _, _ in self.pending_files(
+                download_dir, new, blacklist, target_filetype
+            )
+        }
+        catalog.mark(
+            self.host_ip,
+            [file["FileName"] for file in new if file["FileName"] not in wanted],
+            "skipped",
+        )
+        return catalog.pending(self.host_ip, filetype, start, end)
+
+    def schedule_files(
+        self,
+        scheduler,
+        download_dir,
+        files,
+        blacklist=None,
+        target_filetype=None,
+        check=True,
+    ):
+        """Queue the pending files in a DownloadScheduler instead of downloading
+        them here, returns (target path, converted path) of the queued files.
+        """
+        pending = list(
+            self.pending_files(download_dir, files, blacklist, target_filetype, check)
+        )
+        targets = {file["FileName"]: target for file, target, _ in pending}
+        scheduler.add(
+            self.host_ip,
+            [file for file, _, _ in pending],
+            lambda file: targets[file["FileName"]],
+            user=self.user,
+            password=self.password,
+        )
+        return [(target, convert) for _, target, convert in pending]
+
+    def convert(self, target_file_path, target_file_path_convert):
+        self.logger.debug(f"Converting {target_file_path_convert}...")
+        self.convertFile(target_file_path, target_file_path_convert)
+        self.logger.debug(f"Finished converting {target_file_path_convert}.")
+
     def move_cam(self, direction, step=5):
         match direction:
             case "up":